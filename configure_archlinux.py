@@ -2,12 +2,16 @@ from lib.archinstall import ArchInstall
 
 arch_install = ArchInstall('settings.json', live_system=False)
 
+# GNOME settings, shortcuts and extensions are pre-seeded by
+# install_archlinux.py, applying them again after first boot only write the
+# keys the user changed since
 arch_install.execute_method(arch_install.configure_gnome)
 arch_install.execute_method(arch_install.make_gnome_shortcuts)
 arch_install.execute_method(arch_install.configure_ibus_bamboo)
 arch_install.execute_method(arch_install.enable_gnome_appindicator)
 arch_install.execute_method(arch_install.enable_gnome_vitals_extension)
 arch_install.execute_method(arch_install.configure_gedit)
+arch_install.execute_method(arch_install.apply_gnome_settings)
 arch_install.execute_method(
     arch_install.install_flatpak_packages_from_file,
     'packages_info/arch_linux/flatpak.txt'
@@ -5,9 +5,18 @@ import json
 import os
 import pathlib
 import re
+import shlex
 import subprocess
 
-from lib import diskutils, fileutils
+from lib import dconfutils, diskutils, fileutils, packageutils
+
+
+# marks that HOOKS changed since initramfs was last built, kept on disk so
+# an interrupted install still rebuild it when run again
+INITRAMFS_PENDING_FILE = '/etc/mkinitcpio.d/.initramfs-pending'
+
+# compressors that take -T0 (use all cores)
+MULTITHREAD_COMPRESSIONS = {'zstd', 'xz'}
 
 
 class ArchInstall:
@@ -16,6 +25,15 @@ class ArchInstall:
         self.home_dir = f'/home/{self.settings["username"]}'
         self.partition_layout = self.settings['partition_layout']
         self.live_system = live_system
+        self.device_identities = None
+        self.gnome_settings = []
+        self.gnome_shortcuts = None
+        self.gnome_extensions = []
+        self.package_manifest = None
+        self.known_packages = None
+        self.unknown_packages = {}
+        self.pending_units = []
+        self.pending_memberships = {}
         self.working_dir = (
             os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
         )
@@ -119,6 +137,9 @@ class ArchInstall:
 
         self.settings.update(partnames)
 
+        # partitions and filesystems changed
+        self.refresh_device_identities()
+
         # save new info to settings.json
         with open('settings.json', 'w') as writer:
             json.dump(self.settings, writer, indent=4)
@@ -136,12 +157,19 @@ class ArchInstall:
             'iptables-nft'
         ]
 
+        # lvm2 install its own mkinitcpio hook, installing it later would
+        # rebuild initramfs again
+        if self.partition_layout == 'encrypted':
+            packages.append('lvm2')
+
         subprocess.run(['pacstrap', '/mnt'] + packages)
 
     def configure_fstab(self):
         """configure fstab"""
         with open('/mnt/etc/fstab', 'a') as writer:
-            subprocess.run(['genfstab', '-U', '/mnt'], stdout=writer)
+            writer.write(diskutils.generate_fstab(
+                '/mnt', self.get_device_identities()
+            ))
 
     def configure_time_zone(self):
         """configure time zone"""
@@ -174,20 +202,9 @@ class ArchInstall:
 
         fileutils.backup(pacman_conf_path)
 
-        with open(pacman_conf_path) as reader:
-            content = reader.readlines()
-
-        # find the first line contain multilib config
-        line_number = content.index('#[multilib]\n')
-
-        # comment out 2 lines contain multilib config
-        content[line_number] = content[line_number].replace('#', '')
-        line_number += 1  # to comment next line
-        content[line_number] = content[line_number].replace('#', '')
-
-        # save changes
-        with open(pacman_conf_path, 'w') as writer:
-            writer.writelines(content)
+        # uncomment multilib section and its Include line
+        with fileutils.ConfigEditor(pacman_conf_path) as editor:
+            editor.uncomment(r'^#\[multilib\]$', following=1)
 
     def configure_network(self):
         """configure network"""
@@ -207,69 +224,134 @@ class ArchInstall:
             'pacman', '-Syu', '--needed', '--noconfirm', 'networkmanager'
         ])
 
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'NetworkManager'
-        ])
-
-    def set_root_password(self):
-        """setup root password"""
-        password = (self.settings['root_password'] + '\n') * 2
-        subprocess.run(self.cmd_prefix + ['passwd'], input=password.encode())
-
-    def add_normal_user(self):
-        """add normal user"""
-        real_name = self.settings['user_real_name']
-        username = self.settings['username']
-        password = (self.settings['user_password'] + '\n') * 2
-        user_groups = self.settings['user_groups']
+        self.systemctl_enable('NetworkManager')
+
+    def get_users(self):
+        """get users to add, main user first then 'users' of settings"""
+        # each entry of 'users' is {"real_name": ..., "username": ...,
+        # "password": ... or "password_hash": ..., "groups": [...]}
+        main_user = {
+            'real_name': self.settings['user_real_name'],
+            'username': self.settings['username'],
+            'password': self.settings['user_password'],
+            'groups': self.settings['user_groups']
+        }
+
+        return [main_user] + self.settings.get('users', [])
+
+    def get_groups(self):
+        """get names of existing groups"""
+        with open(f'{self.path_prefix}/etc/group') as reader:
+            return {line.split(':', 1)[0] for line in reader if line.strip()}
+
+    def add_users(self):
+        """add users, set their and root passwords in one batch"""
+        users = self.get_users()
+        existing_groups = self.get_groups()
+
+        # groups created later by packages (e.g. docker) are joined at the
+        # end of install, existing users are skipped so step can be re-run
+        commands = []
+        later_groups = {}
+        for user in users:
+            username = user['username']
+            groups = user.get('groups', [])
+            later_groups[username] = [
+                group for group in groups if group not in existing_groups
+            ]
+            groups = [group for group in groups if group in existing_groups]
+
+            commands.append(
+                f'id -u {shlex.quote(username)} >/dev/null 2>&1 || ' +
+                shlex.join(
+                    ['useradd'] +
+                    (['-G', ','.join(groups)] if groups else []) +
+                    ['-s', '/bin/bash', '-m', username,
+                     '-d', f'/home/{username}',
+                     '-c', user.get('real_name', '')]
+                )
+            )
+        subprocess.run(self.cmd_prefix + ['sh', '-c', '\n'.join(commands)])
 
-        subprocess.run(self.cmd_prefix + [
-            'useradd',
-            '-G', ','.join(user_groups),
-            '-s', '/bin/bash',
-            '-m', f'{username}',
-            '-d', f'/home/{username}',
-            '-c', f'{real_name}'
-        ])
+        for username, groups in later_groups.items():
+            self.add_user_to_groups(groups, username)
 
+        # chpasswd -e take hashes (e.g. from openssl passwd -6)
+        passwords = [f'root:{self.settings["root_password"]}'] + [
+            f'{user["username"]}:{user["password"]}'
+            for user in users if 'password' in user
+        ]
+        password_hashes = [
+            f'{user["username"]}:{user["password_hash"]}'
+            for user in users if 'password_hash' in user
+        ]
         subprocess.run(
-            self.cmd_prefix + ['passwd', f'{username}'],
-            input=password.encode()
+            self.cmd_prefix + ['chpasswd'],
+            input=('\n'.join(passwords) + '\n').encode()
         )
+        if password_hashes:
+            subprocess.run(
+                self.cmd_prefix + ['chpasswd', '-e'],
+                input=('\n'.join(password_hashes) + '\n').encode()
+            )
 
-    def allow_user_in_wheel_group_execute_any_command(self):
-        """allow user in wheel group execute any command"""
-        sudoers_path = '/mnt/etc/sudoers'
+    def add_user_to_groups(self, groups, username=None):
+        """queue adding user (main user by default) to groups"""
+        username = username or self.settings['username']
+        self.pending_memberships.setdefault(username, []).extend(groups)
 
-        fileutils.backup(sudoers_path)
+        # installed system is changed right away
+        if not self.live_system:
+            self.apply_pending_memberships()
 
-        fileutils.multiple_replace_in_line(
-            sudoers_path,
-            rf'^{re.escape("# %wheel ALL=(ALL:ALL) ALL")}.*',
-            [('# ', '')]
-        )
+    def apply_pending_memberships(self):
+        """create missing groups, add each user to all its groups at once"""
+        if not any(self.pending_memberships.values()):
+            return
 
-    def disable_sudo_password_prompt_timeout(self):
-        """disable sudo password prompt timeout"""
+        # shadow tools write into /mnt themselves, no need to chroot
+        if self.live_system:
+            cmd_prefix, prefix = [], ['--prefix', '/mnt']
+        else:
+            cmd_prefix, prefix = self.cmd_prefix, []
+
+        existing_groups = self.get_groups()
+        for group in dict.fromkeys(
+            group for groups in self.pending_memberships.values()
+            for group in groups
+        ):
+            if group not in existing_groups:
+                subprocess.run(cmd_prefix + ['groupadd'] + prefix + [group])
+
+        for username, groups in self.pending_memberships.items():
+            if groups:
+                subprocess.run(cmd_prefix + ['usermod'] + prefix + [
+                    '-aG', ','.join(dict.fromkeys(groups)), username
+                ])
+        self.pending_memberships = {}
+
+    def configure_sudo(self):
+        """let wheel group use sudo, disable or increase its timeouts"""
         sudoers_path = '/mnt/etc/sudoers'
 
+        # one backup of the file as it was before all edits
         fileutils.backup(sudoers_path)
 
-        with open(sudoers_path, 'a') as writer:
-            writer.write('\n## Disable password prompt timeout\n')
-            writer.write('Defaults passwd_timeout=0\n')
+        with fileutils.ConfigEditor(sudoers_path) as editor:
+            editor.uncomment(rf'^{re.escape("# %wheel ALL=(ALL:ALL) ALL")}')
 
-    def increase_sudo_timestamp_timeout(self):
-        """reduce the number of times re-enter password using sudo"""
-        sudoers_path = '/mnt/etc/sudoers'
-
-        fileutils.backup(sudoers_path)
+            editor.ensure_line(
+                'Defaults passwd_timeout=0',
+                r'^Defaults passwd_timeout=',
+                'Disable password prompt timeout'
+            )
 
-        with open(sudoers_path, 'a') as writer:
-            writer.write('\n## Set sudo timestamp timeout\n')
-            writer.write(
+            # reduce the number of times re-enter password using sudo
+            editor.ensure_line(
                 'Defaults timestamp_timeout=' +
-                f'{self.settings["timeout_for_sudo"]}\n'
+                f'{self.settings["timeout_for_sudo"]}',
+                r'^Defaults timestamp_timeout=',
+                'Set sudo timestamp timeout'
             )
 
     def configure_mkinitcpio_for_encrypted_system(self):
@@ -281,17 +363,18 @@ class ArchInstall:
 
         fileutils.backup(mkinitcpio_config_file)
 
-        fileutils.multiple_replace_in_line(
-            mkinitcpio_config_file,
-            rf'^{re.escape("HOOKS")}.*',
-            [
-                (' keyboard', ''),
-                ('autodetect', 'autodetect keyboard keymap'),
-                ('block', 'block encrypt lvm2')
-            ]
-        )
+        # skip HOOKS already configured, so rerun change nothing
+        with fileutils.ConfigEditor(mkinitcpio_config_file) as editor:
+            editor.replace_in_line(
+                r'^HOOKS=(?!.*\bencrypt\b)',
+                [
+                    (' keyboard', ''),
+                    ('autodetect', 'autodetect keyboard keymap'),
+                    ('block', 'block encrypt lvm2')
+                ]
+            )
 
-        self.build_initramfs_image_mkinitcpio()
+        self.set_initramfs_pending(True)
 
     def configure_mkinitcpio_for_hibernation(self):
         """configure mkinitcpio for hibernation"""
@@ -299,29 +382,88 @@ class ArchInstall:
 
         fileutils.backup(mkinitcpio_config_path)
 
-        fileutils.multiple_replace_in_line(
-            mkinitcpio_config_path,
-            rf'^{re.escape("HOOKS")}.*',
-            [('filesystems', 'filesystems resume')]
-        )
+        with fileutils.ConfigEditor(mkinitcpio_config_path) as editor:
+            editor.replace_in_line(
+                r'^HOOKS=(?!.*\bresume\b)',
+                [('filesystems', 'filesystems resume')]
+            )
+
+        self.set_initramfs_pending(True)
 
-        self.build_initramfs_image_mkinitcpio()
+    def set_initramfs_pending(self, is_pending):
+        """record whether initramfs need to be rebuilt"""
+        path = pathlib.Path(f'{self.path_prefix}{INITRAMFS_PENDING_FILE}')
+        if is_pending:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        else:
+            path.unlink(missing_ok=True)
+
+    def is_initramfs_pending(self):
+        """check whether HOOKS changed since initramfs was last built"""
+        return os.path.exists(f'{self.path_prefix}{INITRAMFS_PENDING_FILE}')
+
+    def get_initramfs_compression(self):
+        """get compressor set in mkinitcpio.conf (zstd if not set)"""
+        with open(f'{self.path_prefix}/etc/mkinitcpio.conf') as reader:
+            match = re.search(
+                r'^COMPRESSION=["\']?(\w+)', reader.read(), re.MULTILINE
+            )
+
+        return match.group(1) if match else 'zstd'
 
     def build_initramfs_image_mkinitcpio(self):
         """build initramfs image(s) according to specified preset"""
+        # compress with all cores, other compressors do not take -T0
+        if self.get_initramfs_compression() in MULTITHREAD_COMPRESSIONS:
+            with fileutils.ConfigEditor(
+                f'{self.path_prefix}/etc/mkinitcpio.conf'
+            ) as editor:
+                editor.ensure_line(
+                    'COMPRESSION_OPTIONS=(-T0)',
+                    r'^#?\s*COMPRESSION_OPTIONS='
+                )
+
+        # fallback image is huge and slow to compress
+        if self.settings.get('is_skip_fallback_initramfs', False):
+            with fileutils.ConfigEditor(
+                f'{self.path_prefix}/etc/mkinitcpio.d/linux.preset'
+            ) as editor:
+                editor.ensure_line("PRESETS=('default')", r'^PRESETS=')
+
+            pathlib.Path(
+                f'{self.path_prefix}/boot/initramfs-linux-fallback.img'
+            ).unlink(missing_ok=True)
+
         subprocess.run(self.cmd_prefix + [
             'mkinitcpio', '-p', 'linux'
         ])
 
-    def get_uuid(self, partition):
-        """get partition's UUID"""
-        output = subprocess.run(self.cmd_prefix + [
-            'blkid', '-s', 'UUID', '-o', 'value', f'/dev/{partition}'
-        ], capture_output=True)
+        self.set_initramfs_pending(False)
 
-        uuid = output.stdout.decode().strip()
+    def build_pending_initramfs_image(self):
+        """rebuild initramfs once for all HOOKS changes made so far"""
+        if self.is_initramfs_pending():
+            self.build_initramfs_image_mkinitcpio()
 
-        return uuid
+    def get_device_identities(self):
+        """get identities of all block devices, probed once"""
+        if self.device_identities is None:
+            self.device_identities = diskutils.get_device_identities(
+                self.cmd_prefix
+            )
+
+        return self.device_identities
+
+    def refresh_device_identities(self):
+        """probe block devices again after layout changes"""
+        self.device_identities = None
+
+    def get_uuid(self, partition):
+        """get partition's UUID"""
+        return diskutils.find_device_identity(
+            self.get_device_identities(), f'/dev/{partition}'
+        ).get('UUID', '')
 
     def configure_systemd_bootloader(self):
         """configure systemd bootloader"""
@@ -369,12 +511,54 @@ class ArchInstall:
                     f'resume=UUID={lv_swap_uuid} rw\n'
                 )
 
+    def get_package_manifest(self):
+        """get compiled package lists"""
+        if self.package_manifest is None:
+            self.package_manifest = packageutils.load_manifest(self.pkg_info)
+
+        return self.package_manifest
+
+    def find_unknown_packages(self, group):
+        """get packages of group not in sync databases, once per group"""
+        if group in self.unknown_packages:
+            return self.unknown_packages[group]
+
+        if self.known_packages is None:
+            # multilib of a fresh install is enabled but not synced yet
+            if self.live_system:
+                subprocess.run(self.cmd_prefix + ['pacman', '-Sy'])
+
+            self.known_packages = packageutils.get_known_packages(
+                self.cmd_prefix
+            )
+
+        unknown = packageutils.find_unknown_packages(
+            self.get_package_manifest(), [group], self.known_packages,
+            self.cmd_prefix
+        ).get(group, [])
+        if unknown:
+            print(f'Skip unknown packages in {group}: {", ".join(unknown)}')
+        self.unknown_packages[group] = unknown
+
+        return unknown
+
     def get_packages_from_file(self, file_path):
         """get packages from file"""
-        with open(file_path) as reader:
-            packages = reader.read()
+        list_dir, name = os.path.split(os.path.abspath(file_path))
+        if list_dir == self.pkg_info and name.endswith('.txt'):
+            group = name[:-len('.txt')]
+            packages = self.get_package_manifest()['groups'][group]
+
+            # one mistyped name would make pacman refuse the whole group
+            if group not in packageutils.NON_REPO_GROUPS:
+                unknown = self.find_unknown_packages(group)
+                packages = [
+                    package for package in packages if package not in unknown
+                ]
+
+            return packages
 
-        return packages.splitlines()
+        return packageutils.parse_list(file_path)
 
     def install_intel_drivers(self):
         """install gpu drivers"""
@@ -390,20 +574,14 @@ class ArchInstall:
 
     def enable_bluetooth_service(self):
         """enable bluetooth service"""
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'bluetooth'
-        ])
+        self.systemctl_enable('bluetooth')
 
     def configure_display_manager(self, display_manager):
         """configure display manager"""
         if display_manager == 'gdm':
-            subprocess.run(self.cmd_prefix + [
-                'systemctl', 'enable', 'gdm'
-            ])
+            self.systemctl_enable('gdm')
         elif display_manager == 'sddm':
-            subprocess.run(self.cmd_prefix + [
-                'systemctl', 'enable', 'sddm'
-            ])
+            self.systemctl_enable('sddm')
 
     def install_fonts(self):
         """install fonts"""
@@ -433,29 +611,76 @@ class ArchInstall:
             'virtualbox', 'virtualbox-guest-iso', 'virtualbox-host-dkms'
         ])
 
-        subprocess.run(self.cmd_prefix + [
-            'gpasswd', '-a', f'{self.settings["username"]}', 'vboxusers'
-        ])
+        self.add_user_to_groups(['vboxusers'])
 
     def systemctl_enable(self, unit: str):
-        """enable unit using systemctl"""
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', unit
-        ])
+        """enable unit using systemctl (on install, with pending units)"""
+        if self.live_system:
+            self.pending_units.append(unit)
+        else:
+            subprocess.run(self.cmd_prefix + [
+                'systemctl', 'enable', unit
+            ])
 
     def systemctl_start(self, unit: str):
         """start unit using systemctl"""
+        # installed system is not running, enabled units start on boot
+        if self.live_system:
+            return
+
         subprocess.run(self.cmd_prefix + [
             'systemctl', 'start', unit
         ])
 
+    def enable_pending_units(self):
+        """enable units requested during install with one systemctl call"""
+        units = list(dict.fromkeys(self.pending_units))
+        self.pending_units = []
+
+        # systemctl refuse the whole call if one unit file is missing, e.g.
+        # when the AUR package of a unit failed to build
+        missing_units = [
+            unit for unit in units if not self.is_unit_installed(unit)
+        ]
+        for unit in missing_units:
+            print(f'{unit} is not installed, skip enabling it')
+        units = [unit for unit in units if unit not in missing_units]
+        if not units:
+            return
+
+        # systemctl only create symlinks, no need to chroot
+        enable = ['systemctl', '--root=/mnt', 'enable']
+        if subprocess.run(enable + units).returncode == 0:
+            return
+
+        # enable what we can one at a time
+        for unit in units:
+            if subprocess.run(enable + [unit]).returncode != 0:
+                print(f'Failed to enable {unit}')
+
+    def is_unit_installed(self, unit):
+        """check if unit file of unit is on installed system"""
+        if '.' not in unit:
+            unit += '.service'
+
+        # instance of template unit (name@instance.service) may use only
+        # its template
+        names = [unit]
+        if '@' in unit:
+            name, suffix = unit.split('@', 1)
+            names.append(f'{name}@{suffix[suffix.rindex("."):]}')
+
+        return any(
+            os.path.exists(f'/mnt{unit_dir}/{name}')
+            for unit_dir in ['/etc/systemd/system', '/usr/lib/systemd/system']
+            for name in names
+        )
+
     def install_docker(self):
         """install docker"""
         self.install_packages(['docker', 'docker-compose'])
 
-        subprocess.run(self.cmd_prefix + [
-            'gpasswd', '-a', f'{self.settings["username"]}', 'docker'
-        ])
+        self.add_user_to_groups(['docker'])
 
         self.systemctl_enable('docker.service')
         self.systemctl_start('docker.service')
@@ -508,115 +733,18 @@ class ArchInstall:
         """configure as VirtualBox guest"""
         self.install_packages(['virtualbox-guest-utils'])
 
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'vboxservice'
-        ])
+        self.systemctl_enable('vboxservice')
 
-        subprocess.run(self.cmd_prefix + [
-            'gpasswd', '-a', f'{self.settings["username"]}', 'vboxsf'
-        ])
-
-    def get_gnome_custom_shortcut_indexes(self):
-        """get GNOME custom shortcut indexes"""
-        SCHEMA_TO_LIST = 'org.gnome.settings-daemon.plugins.media-keys'
-
-        output = subprocess.run([
-            'gsettings', 'get', f'{SCHEMA_TO_LIST}', 'custom-keybindings'
-        ], capture_output=True)
-
-        path_list = output.stdout.decode()
-
-        if path_list.strip() == '@as []':
-            indexes = []
-        else:
-            indexes = re.findall(r'\d+', path_list)
-
-        return path_list, indexes
+        self.add_user_to_groups(['vboxsf'])
 
     def add_gnome_shortcut(self, name, key_binding, command):
-        """add a GNOME shortcut"""
-        SCHEMA_TO_LIST = 'org.gnome.settings-daemon.plugins.media-keys'
-        SCHEMA_TO_ITEM = (
-            'org.gnome.settings-daemon.plugins.media-keys.custom-keybinding'
-        )
-        PATH_TO_CUSTOM_KEY = (
-            '/org/gnome/settings-daemon/plugins/media-keys'
-            '/custom-keybindings/custom'
-        )
-
-        path_list, indexes = self.get_gnome_custom_shortcut_indexes()
-        index = len(indexes)
-
-        subprocess.run([
-            'gsettings', 'set',
-            f'{SCHEMA_TO_ITEM}:{PATH_TO_CUSTOM_KEY}{index}/',
-            'name', f'"{name}"'
-        ])
-
-        subprocess.run([
-            'gsettings', 'set',
-            f'{SCHEMA_TO_ITEM}:{PATH_TO_CUSTOM_KEY}{index}/',
-            'binding', f'"{key_binding}"'
-        ])
-
-        subprocess.run([
-            'gsettings', 'set',
-            f'{SCHEMA_TO_ITEM}:{PATH_TO_CUSTOM_KEY}{index}/',
-            'command', f'"{command}"'
-        ])
-
-        # determine new path_list
-        if index == 0:
-            path_list = f"['{PATH_TO_CUSTOM_KEY}{index}/']"
-        else:
-            # -2 here mean ignore the last character ] in old path_list
-            path_list = path_list[:-2] + f", '{PATH_TO_CUSTOM_KEY}{index}/']"
-
-        subprocess.run([
-            'gsettings', 'set', f'{SCHEMA_TO_LIST}',
-            'custom-keybindings', f'{path_list}'
-        ])
-
-    def clear_all_gnome_custom_shortcuts(self):
-        """clear all GNOME custom shortcuts"""
-        SCHEMA_TO_LIST = 'org.gnome.settings-daemon.plugins.media-keys'
-        SCHEMA_TO_ITEM = (
-            'org.gnome.settings-daemon.plugins.media-keys.custom-keybinding'
-        )
-        PATH_TO_CUSTOM_KEY = (
-            '/org/gnome/settings-daemon/plugins/media-keys'
-            '/custom-keybindings/custom'
-        )
-
-        indexes = self.get_gnome_custom_shortcut_indexes()[1]
-
-        for index in indexes:
-            subprocess.run([
-                'gsettings', 'reset',
-                f'{SCHEMA_TO_ITEM}:{PATH_TO_CUSTOM_KEY}{index}/',
-                'name'
-            ])
-
-            subprocess.run([
-                'gsettings', 'reset',
-                f'{SCHEMA_TO_ITEM}:{PATH_TO_CUSTOM_KEY}{index}/',
-                'binding'
-            ])
-
-            subprocess.run([
-                'gsettings', 'reset',
-                f'{SCHEMA_TO_ITEM}:{PATH_TO_CUSTOM_KEY}{index}/',
-                'command'
-            ])
-
-        subprocess.run([
-            'gsettings', 'reset', f'{SCHEMA_TO_LIST}',
-            'custom-keybindings'
-        ])
+        """add a GNOME shortcut (written by apply_gnome_settings)"""
+        self.gnome_shortcuts.append((name, key_binding, command))
 
     def make_gnome_shortcuts(self):
         """make some GNOME shortcuts for frequently program"""
-        self.clear_all_gnome_custom_shortcuts()
+        # shortcuts not added below are removed
+        self.gnome_shortcuts = []
 
         if self.is_package_installed('nautilus'):
             self.add_gnome_shortcut(
@@ -634,11 +762,10 @@ class ArchInstall:
             )
 
             # re-define lockscreen shortcut to use Super in emacs-lsp
-            self.gnome_gsettings_set(
-                'org.gnome.settings-daemon.plugins.media-keys',
-                'screensaver',
-                "['<Primary><Alt>l']"
-            )
+            self.queue_gnome_settings([
+                ('org.gnome.settings-daemon.plugins.media-keys',
+                 'screensaver', "['<Primary><Alt>l']")
+            ])
 
         if self.is_package_installed('doublecmd-qt5'):
             self.add_gnome_shortcut(
@@ -841,159 +968,121 @@ class ArchInstall:
         """install KVM"""
         self.install_packages_from_file(f'{self.pkg_info}/kvm.txt')
 
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'libvirtd'
-        ])
+        self.systemctl_enable('libvirtd')
 
         libvirtd_conf_path = self.path_prefix + '/etc/libvirt/libvirtd.conf'
         fileutils.backup(libvirtd_conf_path)
 
-        fileutils.multiple_replace_in_line(
-            libvirtd_conf_path,
-            rf'^{re.escape("#unix_sock_group = ")}.*',
-            [('#', '')]
-        )
+        with fileutils.ConfigEditor(libvirtd_conf_path) as editor:
+            editor.uncomment(rf'^{re.escape("#unix_sock_group = ")}')
+            editor.uncomment(rf'^{re.escape("#unix_sock_rw_perms = ")}')
 
-        fileutils.multiple_replace_in_line(
-            libvirtd_conf_path,
-            rf'^{re.escape("#unix_sock_rw_perms = ")}.*',
-            [('#', '')]
-        )
+        self.add_user_to_groups(['libvirt', 'kvm'])
 
-        username = self.settings['username']
+    def queue_gnome_settings(self, profile):
+        """queue (schema, key, value) settings for apply_gnome_settings"""
+        self.gnome_settings.extend(profile)
 
-        subprocess.run(self.cmd_prefix + [
-            'gpasswd', '-a', username, 'libvirt'
-        ])
+    def apply_gnome_settings(self):
+        """apply queued GNOME settings, write only changed keys"""
+        if not (self.gnome_settings or self.gnome_extensions) and \
+                self.gnome_shortcuts is None:
+            return
 
-        subprocess.run(self.cmd_prefix + [
-            'gpasswd', '-a', username, 'kvm'
-        ])
+        # installed system get them as defaults in its system database
+        if self.live_system:
+            profile = self.gnome_settings
+            if self.gnome_extensions:
+                profile = profile + [(
+                    'org.gnome.shell', 'enabled-extensions',
+                    dconfutils.format_string_list(self.gnome_extensions)
+                )]
+
+            stats = dconfutils.compile_system_db(
+                '/mnt', profile, self.gnome_shortcuts, self.cmd_prefix
+            )
+        else:
+            # only keys the user changed since install are written again
+            stats = dconfutils.apply_profile(
+                self.gnome_settings, self.gnome_shortcuts
+            )
 
-    def gnome_gsettings_set(self, schema, key, value):
-        """sets the value of KEY to VALUE"""
-        subprocess.run([
-            'gsettings', 'set', f'{schema}', f'{key}', f'{value}'
-        ])
+        self.gnome_settings = []
+        self.gnome_shortcuts = None
+        self.gnome_extensions = []
+        print(
+            f'Applied {stats["changed"]} of {stats["keys"]} GNOME settings ' +
+            f'and removed {stats["removed"]} shortcuts ' +
+            f'in {stats["seconds"]:.2f}s'
+        )
 
     def configure_gnome(self):
         """configure GNOME"""
-        # set default monospace font
+        # font used by the settings below
         if not self.is_package_installed('ttf-cascadia-code'):
             self.install_packages(['ttf-cascadia-code'])
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.interface',
-            'monospace-font-name',
-            'Cascadia Mono 12'
-        )
 
-        # set default interface font
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.interface',
-            'font-name',
-            'Cascadia Mono 12'
-        )
+        # values are GVariant text, strings must be quoted
+        self.queue_gnome_settings([
+            # set default monospace font
+            ('org.gnome.desktop.interface', 'monospace-font-name',
+             "'Cascadia Mono 12'"),
 
-        # set default legacy windows titles font
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.wm.preferences',
-            'titlebar-font',
-            'Cascadia Mono Bold 12'
-        )
+            # set default interface font
+            ('org.gnome.desktop.interface', 'font-name',
+             "'Cascadia Mono 12'"),
 
-        # set default document font
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.interface',
-            'document-font-name',
-            'Cascadia Mono 12'
-        )
+            # set default legacy windows titles font
+            ('org.gnome.desktop.wm.preferences', 'titlebar-font',
+             "'Cascadia Mono Bold 12'"),
 
-        # set font-antialiasing to rgba
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.interface',
-            'font-antialiasing',
-            'rgba'
-        )
+            # set default document font
+            ('org.gnome.desktop.interface', 'document-font-name',
+             "'Cascadia Mono 12'"),
 
-        # switch applications only in current workspace
-        self.gnome_gsettings_set(
-            'org.gnome.shell.app-switcher',
-            'current-workspace-only',
-            'true'
-        )
+            # set font-antialiasing to rgba
+            ('org.gnome.desktop.interface', 'font-antialiasing', "'rgba'"),
 
-        # schedule Night Light
-        self.gnome_gsettings_set(
-            'org.gnome.settings-daemon.plugins.color',
-            'night-light-enabled',
-            'true'
-        )
-        self.gnome_gsettings_set(
-            'org.gnome.settings-daemon.plugins.color',
-            'night-light-schedule-from',
-            '18.0'
-        )
+            # switch applications only in current workspace
+            ('org.gnome.shell.app-switcher', 'current-workspace-only',
+             'true'),
 
-        # show weekday
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.interface',
-            'clock-show-weekday',
-            'true'
-        )
+            # schedule Night Light
+            ('org.gnome.settings-daemon.plugins.color',
+             'night-light-enabled', 'true'),
+            ('org.gnome.settings-daemon.plugins.color',
+             'night-light-schedule-from', '18.0'),
 
-        # empty favorite-apps
-        self.gnome_gsettings_set(
-            'org.gnome.shell',
-            'favorite-apps',
-            '[]'
-        )
+            # show weekday
+            ('org.gnome.desktop.interface', 'clock-show-weekday', 'true'),
 
-        # set default folder viewer nautilus
-        self.gnome_gsettings_set(
-            'org.gnome.nautilus.preferences',
-            'default-folder-viewer',
-            'list-view'
-        )
+            # empty favorite-apps
+            ('org.gnome.shell', 'favorite-apps', '@as []'),
 
-        # set default-zoom-level nautilus
-        self.gnome_gsettings_set(
-            'org.gnome.nautilus.list-view',
-            'default-zoom-level',
-            'large'
-        )
+            # set default folder viewer nautilus
+            ('org.gnome.nautilus.preferences', 'default-folder-viewer',
+             "'list-view'"),
 
-        # disable suspend
-        self.gnome_gsettings_set(
-            'org.gnome.settings-daemon.plugins.power',
-            'sleep-inactive-battery-type',
-            'nothing'
-        )
-        self.gnome_gsettings_set(
-            'org.gnome.settings-daemon.plugins.power',
-            'sleep-inactive-ac-type',
-            'nothing'
-        )
+            # set default-zoom-level nautilus
+            ('org.gnome.nautilus.list-view', 'default-zoom-level',
+             "'large'"),
 
-        # turn off dim screen
-        self.gnome_gsettings_set(
-            'org.gnome.settings-daemon.plugins.power',
-            'idle-dim',
-            'false'
-        )
+            # disable suspend
+            ('org.gnome.settings-daemon.plugins.power',
+             'sleep-inactive-battery-type', "'nothing'"),
+            ('org.gnome.settings-daemon.plugins.power',
+             'sleep-inactive-ac-type', "'nothing'"),
 
-        # turn off screen blank
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.session',
-            'idle-delay',
-            'uint32 0'
-        )
+            # turn off dim screen
+            ('org.gnome.settings-daemon.plugins.power', 'idle-dim', 'false'),
 
-        # show battery percentage
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.interface',
-            'show-battery-percentage',
-            'true'
-        )
+            # turn off screen blank
+            ('org.gnome.desktop.session', 'idle-delay', 'uint32 0'),
+
+            # show battery percentage
+            ('org.gnome.desktop.interface', 'show-battery-percentage',
+             'true')
+        ])
 
     def configure_auto_mount_luks_encrypted_devices(self):
         """configure auto mount LUKS encrypted devices"""
@@ -1009,10 +1098,20 @@ class ArchInstall:
         # secure the luks-passwords directory
         subprocess.run(['chmod', '600', luks_keys_dir])
 
+        # backup original crypttab and fstab before adding any device
+        path_to_crypttab = os.path.join(path_prefix, 'etc/crypttab')
+        path_to_fstab = os.path.join(path_prefix, 'etc/fstab')
+        fileutils.backup(path_to_crypttab)
+        fileutils.backup(path_to_fstab)
+
         devices = self.settings['luks_encrypted_devices']
         username = self.settings['username']
+        crypttab_editor = fileutils.ConfigEditor(path_to_crypttab)
+        fstab_editor = fileutils.ConfigEditor(path_to_fstab)
         for device in devices:
-            part_uuid = device['part_uuid']
+            # UUID can be given directly or looked up by partition name
+            part_uuid = device.get('part_uuid') or \
+                self.get_uuid(device['part_name'])
             mapper_uuid = device['mapper_uuid']
             mount_point_name = device['mount_point_name']
             key = device['key']
@@ -1023,28 +1122,25 @@ class ArchInstall:
                 keyfile_writer.write(key)
 
             # write encryption information to crypttab
-            path_to_crypttab = os.path.join(path_prefix, 'etc/crypttab')
-            fileutils.backup(path_to_crypttab)
-            with open(path_to_crypttab, 'a') as crypttab_writer:
-                crypttab_writer.write(
-                    f'luks-{part_uuid}\t' +
-                    f'UUID={part_uuid}\t' +
-                    f'/etc/{luks_keys_dir_name}/{part_uuid}\t' +
-                    'nofail\n\n'
-                )
+            crypttab_editor.append_block(
+                f'luks-{part_uuid}\t' +
+                f'UUID={part_uuid}\t' +
+                f'/etc/{luks_keys_dir_name}/{part_uuid}\t' +
+                'nofail\n\n'
+            )
 
             # write mount information to fstab
-            path_to_fstab = os.path.join(path_prefix, 'etc/fstab')
-            fileutils.backup(path_to_fstab)
-            with open(path_to_fstab, 'a') as fstab_writer:
-                fstab_writer.write(
-                    f'/dev/disk/by-uuid/{mapper_uuid}\t' +
-                    f'/run/media/{username}/{mount_point_name}\t' +
-                    'auto\t' +
-                    'nosuid,nodev,nofail,x-gvfs-show,' +
-                    'x-systemd.before=httpd.service\t' +
-                    '0\t0\n\n'
-                )
+            fstab_editor.append_block(
+                f'/dev/disk/by-uuid/{mapper_uuid}\t' +
+                f'/run/media/{username}/{mount_point_name}\t' +
+                'auto\t' +
+                'nosuid,nodev,nofail,x-gvfs-show,' +
+                'x-systemd.before=httpd.service\t' +
+                '0\t0\n\n'
+            )
+
+        crypttab_editor.commit()
+        fstab_editor.commit()
 
     def get_optional_deps(self, package_name):
         """get package optional dependencies"""
@@ -1117,13 +1213,8 @@ class ArchInstall:
         """install TLP"""
         self.install_packages(['tlp'])
 
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'tlp'
-        ])
-
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'start', 'tlp'
-        ])
+        self.systemctl_enable('tlp')
+        self.systemctl_start('tlp')
 
     def install_games(self):
         """install games"""
@@ -1140,51 +1231,40 @@ class ArchInstall:
         if not self.is_package_installed('ibus-bamboo'):
             self.install_aur_packages(['ibus-bamboo'])
 
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.input-sources',
-            'sources',
-            "[('xkb', 'us'), ('ibus', 'Bamboo')]"
-        )
-
-        self.gnome_gsettings_set(
-            'org.gnome.desktop.input-sources',
-            'per-window',
-            'true'
-        )
+        self.queue_gnome_settings([
+            ('org.gnome.desktop.input-sources', 'sources',
+             "[('xkb', 'us'), ('ibus', 'Bamboo')]"),
+            ('org.gnome.desktop.input-sources', 'per-window', 'true')
+        ])
 
     def install_vmware_workstation(self):
         """install VMware Workstation"""
         if not self.is_package_installed('vmware-workstation'):
             self.install_aur_packages(['vmware-workstation'])
 
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'vmware-networks'
-        ])
-
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'vmware-usbarbitrator'
-        ])
+        self.systemctl_enable('vmware-networks')
+        self.systemctl_enable('vmware-usbarbitrator')
 
         subprocess.run(self.cmd_prefix + [
             '/usr/lib/vmware/bin/vmware-vmx-debug',
             '--new-sn', 'ZF3R0-FHED2-M80TY-8QYGC-NPKYF'
         ])
 
+    def enable_gnome_extension(self, uuid):
+        """enable GNOME extension (on install, with queued settings)"""
+        # gnome-extensions need a running GNOME Shell
+        if self.live_system:
+            self.gnome_extensions.append(uuid)
+        else:
+            subprocess.run(['gnome-extensions', 'enable', uuid])
+
     def enable_gnome_appindicator(self):
         """enable GNOME AppIndicator"""
-        subprocess.run([
-            'gnome-extensions',
-            'enable',
-            'appindicatorsupport@rgcjonas.gmail.com'
-        ])
+        self.enable_gnome_extension('appindicatorsupport@rgcjonas.gmail.com')
 
     def enable_gnome_vitals_extension(self):
         """enable GNOME vitals extension"""
-        subprocess.run([
-            'gnome-extensions',
-            'enable',
-            'Vitals@CoreCoding.com'
-        ])
+        self.enable_gnome_extension('Vitals@CoreCoding.com')
 
     def configure_ufw(self):
         """configure ufw"""
@@ -1193,9 +1273,7 @@ class ArchInstall:
                 self.is_package_installed('gufw')):
             self.install_packages(['ufw', 'ufw-extras', 'gufw'])
 
-        subprocess.run(self.cmd_prefix + [
-            'systemctl', 'enable', 'ufw'
-        ])
+        self.systemctl_enable('ufw')
 
         subprocess.run(self.cmd_prefix + [
             'ufw', 'enable'
@@ -1247,58 +1325,37 @@ class ArchInstall:
             self.install_packages(
                 ['gnome-builder', 'gnome-builder-libide-docs']
             )
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.preferences.editor',
-            'scheme',
-            'builder'
-        )
 
-        # display right margin
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.preferences.editor',
-            'display-right-margin',
-            'true'
-        )
+        self.queue_gnome_settings([
+            ('org.gnome.gedit.preferences.editor', 'scheme', "'builder'"),
 
-        # insert spaces
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.preferences.editor',
-            'insert-spaces',
-            'true'
-        )
+            # display right margin
+            ('org.gnome.gedit.preferences.editor', 'display-right-margin',
+             'true'),
 
-        # set tabs-size
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.preferences.editor',
-            'tabs-size',
-            'uint32 4'
-        )
+            # insert spaces
+            ('org.gnome.gedit.preferences.editor', 'insert-spaces', 'true'),
 
-        # display overview map
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.preferences.editor',
-            'display-overview-map',
-            'true'
-        )
+            # set tabs-size
+            ('org.gnome.gedit.preferences.editor', 'tabs-size', 'uint32 4'),
 
-        # set background pattern
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.preferences.editor',
-            'background-pattern',
-            'grid'
-        )
+            # display overview map
+            ('org.gnome.gedit.preferences.editor', 'display-overview-map',
+             'true'),
 
-        # enable plugins
-        self.gnome_gsettings_set(
-            'org.gnome.gedit.plugins',
-            'active-plugins',
-            "['codecomment', 'colorpicker', 'wordcompletion', 'commander', \
-                'bracketcompletion', 'smartspaces', 'spell', 'devhelp', \
-                    'sessionsaver', 'git', 'terminal', 'sort', 'filebrowser', \
-                        'modelines', 'docinfo', 'quickhighlight', \
-                            'multiedit', 'drawspaces', 'bookmarks', \
-                                'quickopen', 'findinfiles', 'externaltools']"
-        )
+            # set background pattern
+            ('org.gnome.gedit.preferences.editor', 'background-pattern',
+             "'grid'"),
+
+            # enable plugins
+            ('org.gnome.gedit.plugins', 'active-plugins',
+             "['codecomment', 'colorpicker', 'wordcompletion', " +
+             "'commander', 'bracketcompletion', 'smartspaces', 'spell', " +
+             "'devhelp', 'sessionsaver', 'git', 'terminal', 'sort', " +
+             "'filebrowser', 'modelines', 'docinfo', 'quickhighlight', " +
+             "'multiedit', 'drawspaces', 'bookmarks', 'quickopen', " +
+             "'findinfiles', 'externaltools']")
+        ])
 
     def execute_method(self, method, *args):
         """execute another method then release resources if needed"""
@@ -1322,13 +1379,8 @@ class ArchInstall:
         self.execute_method(self.configure_localization)
         self.execute_method(self.enable_multilib)
         self.execute_method(self.configure_network)
-        self.execute_method(self.set_root_password)
-        self.execute_method(self.add_normal_user)
-        self.execute_method(
-            self.allow_user_in_wheel_group_execute_any_command
-        )
-        self.execute_method(self.disable_sudo_password_prompt_timeout)
-        self.execute_method(self.increase_sudo_timestamp_timeout)
+        self.execute_method(self.add_users)
+        self.execute_method(self.configure_sudo)
 
         if self.partition_layout == 'encrypted':
             self.execute_method(
@@ -1336,4 +1388,5 @@ class ArchInstall:
             )
 
         self.execute_method(self.configure_mkinitcpio_for_hibernation)
+        self.execute_method(self.build_pending_initramfs_image)
         self.execute_method(self.configure_systemd_bootloader)
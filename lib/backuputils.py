@@ -0,0 +1,327 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+import hashlib
+import os
+import queue
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from lib import fileutils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# content defined chunking cut only between 4 KiB blocks (the block size of
+# filesystems inside the images), average chunk size is about 1 MiB
+BLOCK_SIZE = 4096
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 ** 2
+CUT_MASK = 0xff
+READ_SIZE = 4 * 1024 ** 2
+
+COMPRESSED_EXTENSION = '.zst' if zstandard else '.zz'
+
+
+def get_chunk_path(chunks_dir, digest, extension=''):
+    """get path of chunk file (grouped by 2 first hex digits)"""
+    return os.path.join(chunks_dir, digest[:2], digest + extension)
+
+
+def is_chunk_stored(chunks_dir, digest):
+    """check whether chunk is in store (with zstd or zlib)"""
+    return any(
+        os.path.exists(get_chunk_path(chunks_dir, digest, extension))
+        for extension in ('.zst', '.zz')
+    )
+
+
+def store_chunk(chunks_dir, digest, data, extension=''):
+    """store chunk if not stored yet, return number of bytes written"""
+    path = get_chunk_path(chunks_dir, digest, extension)
+    if os.path.exists(path):
+        return 0
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # same chunk may be stored by two backups at once
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as writer:
+        writer.write(data)
+    os.replace(temp_path, path)
+
+    return len(data)
+
+
+def read_chunk(chunks_dir, digest):
+    """read chunk from store, decompress and verify it"""
+    for extension in ('.zst', '.zz'):
+        path = get_chunk_path(chunks_dir, digest, extension)
+        if os.path.exists(path):
+            break
+    else:
+        raise FileNotFoundError(f'chunk {digest} not found in {chunks_dir}')
+
+    with open(path, 'rb') as reader:
+        data = reader.read()
+
+    if extension == '.zst':
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f'chunk {digest} is corrupted')
+
+    return data
+
+
+def compress_chunk(data, local):
+    """compress chunk with zstd (zlib if zstandard is not installed)"""
+    if not zstandard:
+        return zlib.compress(data, 1)
+
+    # compressor objects can not be shared between threads
+    if not hasattr(local, 'compressor'):
+        local.compressor = zstandard.ZstdCompressor(level=3)
+
+    return local.compressor.compress(data)
+
+
+def read_data(path_to_image, blocks, throttle=None):
+    """pipeline stage: read data segments of image, skip holes"""
+    with open(path_to_image, 'rb') as reader:
+        fd = reader.fileno()
+        size = os.fstat(fd).st_size
+        for start, end in fileutils.iter_data_segments(fd, size):
+            offset = start
+            while offset < end:
+                count = min(READ_SIZE, end - offset)
+                if throttle:
+                    throttle.consume(count)
+
+                data = os.pread(fd, count, offset)
+                if not data:
+                    break
+
+                blocks.put((offset, data))
+                offset += len(data)
+
+
+def cut_chunks(blocks, chunks):
+    """pipeline stage: cut data into content defined chunks"""
+    pending = []
+    pending_start = pending_end = 0
+
+    def flush():
+        if pending:
+            chunks.put((pending_start, b''.join(pending)))
+            pending.clear()
+
+    while (block := blocks.get()) is not None:
+        offset, data = block
+
+        # a hole between segments always end the chunk
+        if offset != pending_end:
+            flush()
+            pending_start = pending_end = offset
+
+        view = memoryview(data)
+        for start in range(0, len(data), BLOCK_SIZE):
+            piece = view[start:start + BLOCK_SIZE]
+            if not pending:
+                pending_start = offset + start
+            pending.append(piece)
+            pending_end = offset + start + len(piece)
+
+            length = pending_end - pending_start
+            if length >= MAX_CHUNK_SIZE or (
+                length >= MIN_CHUNK_SIZE and
+                zlib.crc32(piece) & CUT_MASK == 0
+            ):
+                flush()
+
+    flush()
+
+
+def hash_chunks(chunks, to_compress, entries, chunks_dir):
+    """pipeline stage: hash chunks, send new ones to compress"""
+    seen = set()
+
+    while (chunk := chunks.get()) is not None:
+        offset, data = chunk
+
+        if data.count(0) == len(data):
+            entries.append([offset, len(data), None])
+            continue
+
+        digest = hashlib.sha256(data).hexdigest()
+        entries.append([offset, len(data), digest])
+
+        if digest not in seen and not is_chunk_stored(chunks_dir, digest):
+            to_compress.put((digest, data))
+        seen.add(digest)
+
+
+def compress_chunks(to_compress, to_write, local):
+    """pipeline stage: compress new chunks"""
+    while (chunk := to_compress.get()) is not None:
+        digest, data = chunk
+        to_write.put((digest, len(data), compress_chunk(data, local)))
+
+
+def write_chunks(to_write, chunks_dir, stats):
+    """pipeline stage: write compressed chunks to store"""
+    while (chunk := to_write.get()) is not None:
+        digest, size, data = chunk
+        written = store_chunk(chunks_dir, digest, data, COMPRESSED_EXTENSION)
+        if written:
+            stats['new'] += size
+            stats['written'] += written
+            stats['paths'].append(
+                get_chunk_path(chunks_dir, digest, COMPRESSED_EXTENSION)
+            )
+
+
+def run_stage(stage, args, input_queue, output_queue, consumers=1):
+    """run pipeline stage, always tell consumers when it is done"""
+    errors = []
+
+    def run():
+        try:
+            stage(*args)
+        except Exception as error:
+            errors.append(error)
+
+            # keep draining input so previous stage is not blocked
+            if input_queue is not None:
+                while input_queue.get() is not None:
+                    pass
+        finally:
+            if output_queue is not None:
+                for _ in range(consumers):
+                    output_queue.put(None)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    return thread, errors
+
+
+def backup_image(path_to_image, chunks_dir, throttle=None):
+    """store new chunks of image in shared store, return manifest"""
+    blocks = queue.Queue(maxsize=4)
+    chunks = queue.Queue(maxsize=4)
+    to_compress = queue.Queue(maxsize=os.cpu_count() * 2)
+    to_write = queue.Queue(maxsize=os.cpu_count() * 2)
+    entries = []
+    stats = {
+        'size': os.path.getsize(path_to_image), 'new': 0, 'written': 0,
+        'paths': []
+    }
+
+    # writer is done after the last compressor
+    compressor_count = os.cpu_count()
+    compressors = threading.Barrier(
+        compressor_count, action=lambda: to_write.put(None)
+    )
+
+    def compress_stage(local):
+        try:
+            compress_chunks(to_compress, to_write, local)
+        except Exception:
+            while to_compress.get() is not None:
+                pass
+            raise
+        finally:
+            compressors.wait()
+
+    stages = [
+        run_stage(
+            read_data, (path_to_image, blocks, throttle), None, blocks
+        ),
+        run_stage(cut_chunks, (blocks, chunks), blocks, chunks),
+        run_stage(
+            hash_chunks, (chunks, to_compress, entries, chunks_dir),
+            chunks, to_compress, compressor_count
+        ),
+        run_stage(write_chunks, (to_write, chunks_dir, stats), to_write, None)
+    ]
+    for _ in range(compressor_count):
+        stages.append(run_stage(
+            compress_stage, (threading.local(),), None, None
+        ))
+
+    for thread, errors in stages:
+        thread.join()
+        if errors:
+            raise errors[0]
+
+    manifest = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'size': stats['size'],
+        'chunking': 'cdc',
+        'chunks': entries
+    }
+
+    return manifest, stats
+
+
+def restore_image(manifest, chunks_dir, path_to_image):
+    """reassemble image by streaming chunks into place"""
+    with open(path_to_image, 'wb') as writer:
+        # zero chunks and holes are left as holes
+        writer.truncate(manifest['size'])
+
+        for offset, _, digest in manifest['chunks']:
+            if digest is not None:
+                os.pwrite(
+                    writer.fileno(), read_chunk(chunks_dir, digest), offset
+                )
+
+        os.fsync(writer.fileno())
+
+
+def get_backup_points(vm_backup_dir):
+    """get point-in-time backup directories, oldest first"""
+    if not os.path.isdir(vm_backup_dir):
+        return []
+
+    return sorted(
+        name for name in os.listdir(vm_backup_dir)
+        if os.path.isfile(os.path.join(vm_backup_dir, name, 'manifest.json'))
+    )
+
+
+def get_chunks_dir(point_dir, manifest):
+    """get chunk store of a point-in-time backup"""
+    return os.path.normpath(os.path.join(point_dir, manifest['chunks_dir']))
+
+
+def get_digests(manifest):
+    """get unique digests of stored chunks of a backup, in image order"""
+    return list(dict.fromkeys(
+        digest for _, _, digest in manifest['chunks'] if digest
+    ))
+
+
+def verify_chunks(chunks_dir, digests):
+    """verify chunks in parallel, return error of each bad chunk"""
+    def verify(digest):
+        try:
+            read_chunk(chunks_dir, digest)
+        except Exception as error:
+            return digest, str(error)
+
+        return digest, None
+
+    with ThreadPoolExecutor(os.cpu_count() * 2) as executor:
+        return {
+            digest: error
+            for digest, error in executor.map(verify, digests)
+            if error
+        }
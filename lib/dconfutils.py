@@ -0,0 +1,217 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+import itertools
+import os
+import subprocess
+import time
+
+from lib import fileutils
+
+MEDIA_KEYS_SCHEMA = 'org.gnome.settings-daemon.plugins.media-keys'
+CUSTOM_KEYBINDING_SCHEMA = MEDIA_KEYS_SCHEMA + '.custom-keybinding'
+CUSTOM_KEYBINDINGS_DIR = (
+    '/org/gnome/settings-daemon/plugins/media-keys/custom-keybindings/'
+)
+
+# system database read by every user after their own one
+SYSTEM_DB = 'local'
+USER_PROFILE = f'user-db:user\nsystem-db:{SYSTEM_DB}\n'
+
+
+def get_dir_path(schema):
+    """get dconf directory of schema (schema:/path/ for relocatable one)"""
+    if ':' in schema:
+        return schema.split(':', 1)[1]
+
+    # GNOME schemas with fixed path are stored under their own name
+    return '/' + schema.replace('.', '/') + '/'
+
+
+def format_string(text):
+    """format text as GVariant string the way dconf dump print it"""
+    text = text.replace('\\', '\\\\')
+    if "'" in text and '"' not in text:
+        return f'"{text}"'
+
+    return "'" + text.replace("'", "\\'") + "'"
+
+
+def format_string_list(texts):
+    """format list of text as GVariant string array"""
+    if not texts:
+        return '@as []'
+
+    return '[' + ', '.join(format_string(text) for text in texts) + ']'
+
+
+def parse_keyfile(text, dir_path='/'):
+    """parse dconf keyfile into {directory: {key: value}}"""
+    settings = {}
+    keys = None
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1].strip('/')
+            directory = dir_path + section + '/' if section else dir_path
+            keys = settings.setdefault(directory, {})
+        elif keys is not None and '=' in line:
+            key, value = line.split('=', 1)
+            keys[key.strip()] = value.strip()
+
+    return settings
+
+
+def format_keyfile(settings, dir_path='/'):
+    """format {directory: {key: value}} as dconf keyfile"""
+    sections = []
+
+    for directory, keys in sorted(settings.items()):
+        section = directory[len(dir_path):].strip('/') or '/'
+        lines = [f'[{section}]']
+        lines += [f'{key}={value}' for key, value in sorted(keys.items())]
+        sections.append('\n'.join(lines))
+
+    return '\n\n'.join(sections) + '\n'
+
+
+def read_settings(dir_path='/'):
+    """read all keys set under directory in one dconf call"""
+    output = subprocess.run(
+        ['dconf', 'dump', dir_path],
+        capture_output=True, text=True, check=True
+    ).stdout
+
+    return parse_keyfile(output, dir_path)
+
+
+def write_settings(settings):
+    """write keys of many directories as one dconf change"""
+    subprocess.run(
+        ['dconf', 'load', '/'],
+        input=format_keyfile(settings), text=True, check=True
+    )
+
+
+def reset_dirs(directories):
+    """remove all keys under directories"""
+    for directory in directories:
+        subprocess.run(['dconf', 'reset', '-f', directory], check=True)
+
+
+def get_shortcut_profile(shortcuts, current):
+    """get profile of (name, binding, command) shortcuts, stale slots"""
+    slots = {
+        directory: keys for directory, keys in current.items()
+        if directory.startswith(CUSTOM_KEYBINDINGS_DIR) and
+        directory != CUSTOM_KEYBINDINGS_DIR
+    }
+    slot_of_name = {
+        keys.get('name'): directory for directory, keys in slots.items()
+    }
+
+    new_paths = (
+        f'{CUSTOM_KEYBINDINGS_DIR}custom{index}/'
+        for index in itertools.count()
+    )
+
+    # shortcut keep its slot so only changed binding or command is written
+    paths = []
+    for name, _, _ in shortcuts:
+        path = slot_of_name.get(format_string(name))
+        if path is None:
+            path = next(path for path in new_paths if path not in slots)
+        paths.append(path)
+
+    profile = [(
+        MEDIA_KEYS_SCHEMA, 'custom-keybindings', format_string_list(paths)
+    )]
+    for path, (name, binding, command) in zip(paths, shortcuts):
+        schema = f'{CUSTOM_KEYBINDING_SCHEMA}:{path}'
+        profile += [
+            (schema, 'name', format_string(name)),
+            (schema, 'binding', format_string(binding)),
+            (schema, 'command', format_string(command))
+        ]
+
+    return profile, sorted(set(slots) - set(paths))
+
+
+def diff_profile(profile, current):
+    """get keys of profile whose value differ from current settings"""
+    changes = {}
+
+    # value is GVariant text as printed by dconf dump, e.g. 'text' or
+    # uint32 0, so that unchanged keys compare equal
+    for schema, key, value in profile:
+        directory = get_dir_path(schema)
+        if current.get(directory, {}).get(key) != value:
+            changes.setdefault(directory, {})[key] = value
+
+    return changes
+
+
+def apply_profile(profile, shortcuts=None):
+    """apply list of (schema, key, value), return timing and key counts"""
+    start = time.monotonic()
+    current = read_settings()
+    stale_dirs = []
+
+    # None leave custom shortcuts alone, [] remove all of them
+    if shortcuts is not None:
+        shortcut_profile, stale_dirs = get_shortcut_profile(
+            shortcuts, current
+        )
+        profile = profile + shortcut_profile
+
+    changes = diff_profile(profile, current)
+    if changes:
+        write_settings(changes)
+    reset_dirs(stale_dirs)
+
+    return {
+        'keys': len(profile),
+        'changed': sum(len(keys) for keys in changes.values()),
+        'removed': len(stale_dirs),
+        'seconds': time.monotonic() - start
+    }
+
+
+def compile_system_db(root, profile, shortcuts=None, cmd_prefix=None):
+    """compile profile into system database of system mounted at root"""
+    start = time.monotonic()
+    if shortcuts is not None:
+        profile = profile + get_shortcut_profile(shortcuts, {})[0]
+    settings = diff_profile(profile, {})
+
+    keyfile_dir = f'/etc/dconf/db/{SYSTEM_DB}.d'
+    os.makedirs(f'{root}{keyfile_dir}', exist_ok=True)
+    with open(f'{root}{keyfile_dir}/00-archinstall', 'w') as writer:
+        writer.write(format_keyfile(settings))
+
+    # without a profile dconf only read the user database
+    profile_path = f'{root}/etc/dconf/profile/user'
+    if os.path.exists(profile_path):
+        with fileutils.ConfigEditor(profile_path) as editor:
+            editor.ensure_line(f'system-db:{SYSTEM_DB}')
+    else:
+        os.makedirs(os.path.dirname(profile_path), exist_ok=True)
+        with open(profile_path, 'w') as writer:
+            writer.write(USER_PROFILE)
+
+    subprocess.run((cmd_prefix or []) + [
+        'dconf', 'compile', f'/etc/dconf/db/{SYSTEM_DB}', keyfile_dir
+    ], check=True)
+
+    key_count = sum(len(keys) for keys in settings.values())
+
+    return {
+        'keys': key_count,
+        'changed': key_count,
+        'removed': 0,
+        'seconds': time.monotonic() - start
+    }
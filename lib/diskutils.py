@@ -1,10 +1,21 @@
 # author: Le Anh Tai
 # email: leanhtai01@gmail.com
 # GitHub: https://github.com/leanhtai01
+import hashlib
+import mmap
+import os
 import pathlib
+import queue
+import re
 import subprocess
+import threading
 import time
 
+from lib import fileutils
+
+# size of each chunk when streaming an image to a device
+CHUNK_SIZE = 4 * 1024 ** 2
+
 
 def wipe_device(device):
     """wipe everything from (signature, partition, ...)"""
@@ -165,6 +176,82 @@ def get_size_in_byte(partition):
     return int(output.stdout.decode())
 
 
+def get_device_identities(cmd_prefix=None):
+    """get UUID, PARTUUID, LABEL and TYPE of every block device at once"""
+    # bypass blkid cache, it is stale right after formatting, devices can
+    # only be probed by root (cmd_prefix e.g. ['sudo'])
+    output = subprocess.run((cmd_prefix or []) + [
+        'blkid', '-c', '/dev/null', '-o', 'export'
+    ], capture_output=True).stdout.decode()
+
+    # devices are keyed by real path, so /dev/vg/lv and /dev/mapper/vg-lv
+    # are the same device
+    identities = {}
+    for block in output.strip().split('\n\n'):
+        identity = dict(
+            line.split('=', 1) for line in block.splitlines() if '=' in line
+        )
+        if 'DEVNAME' in identity:
+            identities[os.path.realpath(identity['DEVNAME'])] = identity
+
+    return identities
+
+
+def find_device_identity(identities, device_path):
+    """get identity of device (e.g. /dev/sda1, /dev/vg/lv)"""
+    return identities.get(os.path.realpath(device_path), {})
+
+
+def generate_fstab(root, identities):
+    """generate fstab of filesystems mounted under root and active swaps"""
+    entries = []
+
+    with open('/proc/self/mounts') as reader:
+        mounts = [line.split() for line in reader]
+
+    for source, target, fs_type, options, *_ in mounts:
+        # mount points have octal escapes for spaces, ..., other characters
+        # are raw UTF-8
+        target = re.sub(
+            rb'\\([0-7]{3})',
+            lambda match: bytes([int(match.group(1), 8)]),
+            target.encode()
+        ).decode()
+        if not source.startswith('/dev/') or \
+                (target != root and not target.startswith(f'{root}/')):
+            continue
+
+        mount_point = '/' + target[len(root):].strip('/')
+
+        # fstab fields are separated by whitespace, escape it back
+        fstab_mount_point = re.sub(
+            r'[ \t\n\\]', lambda match: f'\\{ord(match.group()):03o}',
+            mount_point
+        )
+        uuid = find_device_identity(identities, source).get('UUID')
+        entries.append(
+            f'# {source}\n' +
+            f'{f"UUID={uuid}" if uuid else source}\t{fstab_mount_point}\t' +
+            f'{fs_type}\t{options}\t0 {1 if mount_point == "/" else 2}\n'
+        )
+
+    with open('/proc/swaps') as reader:
+        swaps = [line.split() for line in reader.readlines()[1:]]
+
+    for source, swap_type, *_ in swaps:
+        if swap_type != 'partition':
+            continue
+
+        uuid = find_device_identity(identities, source).get('UUID')
+        entries.append(
+            f'# {source}\n' +
+            f'{f"UUID={uuid}" if uuid else source}\tnone\tswap\t' +
+            'defaults\t0 0\n'
+        )
+
+    return '\n'.join(entries)
+
+
 def byte_to_mebibyte(byte):
     """convert byte to mebibyte"""
     return byte // (1024 ** 2)
@@ -439,11 +526,247 @@ def encrypt_device(device, encrypt_name, username, password):
     ])
 
 
+def hash_chunks(chunks, digests, whole):
+    """hash chunks from queue until None is received"""
+    while (chunk := chunks.get()) is not None:
+        digests.append(hashlib.sha256(chunk).digest())
+        whole.update(chunk)
+
+
+def stream_file_to_device(path_to_file, device_path):
+    """copy file to device, hash it on another thread while writing"""
+    chunks = queue.Queue(maxsize=8)
+    digests = []
+    whole = hashlib.sha256()
+    hasher = threading.Thread(
+        target=hash_chunks, args=(chunks, digests, whole)
+    )
+    hasher.start()
+
+    size = 0
+    try:
+        with open(path_to_file, 'rb') as reader, \
+                open(device_path, 'wb', buffering=0) as writer:
+            while chunk := reader.read(CHUNK_SIZE):
+                chunks.put(chunk)
+                writer.write(chunk)
+                size += len(chunk)
+
+            # make sure everything reach the device before verifying
+            os.fsync(writer.fileno())
+    finally:
+        chunks.put(None)
+        hasher.join()
+
+    return {
+        'size': size,
+        'digests': digests,
+        'sha256': whole.hexdigest()
+    }
+
+
+def find_first_difference(path_to_file, offset, data):
+    """return offset of first byte in data different from file"""
+    with open(path_to_file, 'rb') as reader:
+        reader.seek(offset)
+        expected = reader.read(len(data))
+
+    # compare block by block first, then byte by byte in the bad block
+    block_size = 4096
+    for start in range(0, len(data), block_size):
+        end = start + block_size
+        if data[start:end] != expected[start:end]:
+            for i in range(start, min(end, len(data))):
+                if i >= len(expected) or data[i] != expected[i]:
+                    return offset + i
+
+    return offset
+
+
+def verify_device(device_path, size, digests, path_to_file=None):
+    """read back written range of device, return first mismatch offset"""
+    fd = fileutils.open_direct(device_path)
+    buffer = mmap.mmap(-1, CHUNK_SIZE)
+
+    try:
+        for index, digest in enumerate(digests):
+            offset = index * CHUNK_SIZE
+            length = min(CHUNK_SIZE, size - offset)
+
+            # direct I/O read full aligned chunk, only compare written part
+            read = fileutils.read_direct(fd, buffer, offset)
+            if read < length:
+                return offset + read
+
+            data = buffer[:length]
+            if hashlib.sha256(data).digest() != digest:
+                # only the bad chunk of source is read again
+                if path_to_file:
+                    return find_first_difference(path_to_file, offset, data)
+
+                return offset
+    finally:
+        buffer.close()
+        os.close(fd)
+
+    return None
+
+
 def write_hybrid_iso_to_usb(usb, path_to_iso):
-    """write hybrid ISO to usb"""
+    """write hybrid ISO to usb, return information for verifying"""
     wipe_device(usb)
     create_partition(usb, '8309', 'BOOTUSB', '0')
 
-    subprocess.run([
-        'dd', f'if={path_to_iso}', f'of=/dev/{usb}', 'bs=4M', 'conv=sync'
-    ])
+    return stream_file_to_device(path_to_iso, f'/dev/{usb}')
+
+
+def power_off_usb(usb):
+    """power off usb, so it is safe to unplug"""
+    subprocess.run(['udisksctl', 'power-off', '-b', f'/dev/{usb}'])
+
+
+class ChunkRing:
+    """read a file once and share its last chunks with many writers"""
+
+    def __init__(self, path_to_file, writers, ring_size=16):
+        self.path_to_file = path_to_file
+        self.ring_size = ring_size
+        self.chunks = {}
+        self.next_index = 0
+        self.is_eof = False
+        self.digests = []
+        self.size = 0
+        self.error = None
+
+        # next chunk index each active writer want
+        self.positions = dict.fromkeys(writers, 0)
+        self.condition = threading.Condition()
+
+    def read_all(self):
+        """read file into the ring, stay at most ring_size ahead"""
+        try:
+            with open(self.path_to_file, 'rb') as reader:
+                while self.wait_for_room():
+                    chunk = reader.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+
+                    self.digests.append(hashlib.sha256(chunk).digest())
+                    self.size += len(chunk)
+
+                    with self.condition:
+                        evicted_index = self.next_index - self.ring_size
+                        self.chunks[self.next_index] = chunk
+                        self.chunks.pop(evicted_index, None)
+                        self.next_index += 1
+                        self.condition.notify_all()
+        except OSError as error:
+            self.error = error
+        finally:
+            with self.condition:
+                self.is_eof = True
+                self.condition.notify_all()
+
+    def wait_for_room(self):
+        """wait until fastest writer is close, False if no writer left"""
+        with self.condition:
+            # no need to read further ahead than the fastest writer
+            self.condition.wait_for(
+                lambda: not self.positions or
+                self.next_index - max(self.positions.values()) <
+                self.ring_size
+            )
+
+            return bool(self.positions)
+
+    def get(self, writer, index, reader):
+        """get chunk for writer, read it from file if it left the ring"""
+        with self.condition:
+            self.positions[writer] = index
+            self.condition.notify_all()
+            self.condition.wait_for(
+                lambda: index < self.next_index or self.is_eof
+            )
+
+            if self.error:
+                raise self.error
+
+            if index in self.chunks:
+                return self.chunks[index]
+
+            if index >= self.next_index:
+                return b''
+
+        # slow writer fall behind the ring, it read the chunk itself so
+        # the others are not stalled (mostly served from page cache)
+        return os.pread(reader.fileno(), CHUNK_SIZE, index * CHUNK_SIZE)
+
+    def leave(self, writer):
+        """remove a finished or failed writer"""
+        with self.condition:
+            self.positions.pop(writer, None)
+            self.condition.notify_all()
+
+
+def flash_usb_from_ring(ring, usb, results, is_verify=False):
+    """write chunks from ring to usb then power it off"""
+    result = {'usb': usb, 'size': 0, 'status': 'done'}
+    results.append(result)
+    start_time = time.monotonic()
+
+    try:
+        wipe_device(usb)
+        create_partition(usb, '8309', 'BOOTUSB', '0')
+
+        with open(ring.path_to_file, 'rb') as reader, \
+                open(f'/dev/{usb}', 'wb', buffering=0) as writer:
+            index = 0
+            while chunk := ring.get(usb, index, reader):
+                writer.write(chunk)
+                result['size'] += len(chunk)
+                index += 1
+
+            os.fsync(writer.fileno())
+    except OSError as error:
+        result['status'] = f'failed: {error.strerror}'
+        return
+    finally:
+        ring.leave(usb)
+        result['seconds'] = time.monotonic() - start_time
+
+    if is_verify:
+        try:
+            mismatch_offset = verify_device(
+                f'/dev/{usb}', ring.size, ring.digests, ring.path_to_file
+            )
+        except OSError as error:
+            result['status'] = f'verify failed: {error.strerror}'
+            return
+
+        if mismatch_offset is not None:
+            result['status'] = f'mismatch at {mismatch_offset}'
+            return
+
+        result['status'] = 'verified'
+
+    power_off_usb(usb)
+
+
+def write_hybrid_iso_to_usbs(usbs, path_to_iso, is_verify=False):
+    """write hybrid ISO to many usbs at once, read the ISO only once"""
+    ring = ChunkRing(path_to_iso, usbs)
+    results = []
+
+    threads = [threading.Thread(target=ring.read_all)]
+    for usb in usbs:
+        threads.append(threading.Thread(
+            target=flash_usb_from_ring, args=(ring, usb, results, is_verify)
+        ))
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results
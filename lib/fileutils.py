@@ -1,38 +1,482 @@
 # author: Le Anh Tai
 # email: leanhtai01@gmail.com
 # GitHub: https://github.com/leanhtai01
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import hashlib
+import json
+import mmap
+import os
 import re
-import subprocess
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# ioctl request to share extents of a file (reflink) on btrfs, xfs,...
+FICLONE = 0x40049409
+
+# fallocate mode to deallocate a range but keep file size
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+COPY_CHUNK_SIZE = 4 * 1024 ** 2
+ZERO_CHUNK = bytes(COPY_CHUNK_SIZE)
+
+HASH_CHUNK_SIZE = 64 * 1024 ** 2
+
+# backups of files in a directory are listed in its manifest
+BACKUP_MANIFEST = '.backups.json'
+BACKUP_KEEP = 5
+
+
+def backup(file_name, keep=BACKUP_KEEP):
+    """backup a file use current datetime, return path to the backup"""
+    if not os.path.exists(file_name):
+        return None
+
+    # backup names are relative, so /mnt/etc is still /etc after reboot
+    dir_name = os.path.dirname(os.path.abspath(file_name))
+    manifest_path = os.path.join(dir_name, BACKUP_MANIFEST)
+    manifest = load_json(manifest_path) or {}
+    backups = [
+        entry for entry in manifest.get(os.path.basename(file_name), [])
+        if os.path.exists(os.path.join(dir_name, entry['name']))
+    ]
+
+    # content same as the latest backup need no new one
+    digest = hash_file(file_name)
+    if backups and backups[-1]['sha256'] == digest:
+        return os.path.join(dir_name, backups[-1]['name'])
 
-def backup(file_name):
-    """backup a file use current datetime"""
     current_datetime = str(datetime.now()).replace(' ', '_')
-    subprocess.run([
-        'cp',
-        file_name,
-        file_name + '_' + current_datetime + '.bak'
-    ])
-
-
-def multiple_replace_in_line(file_name, pattern, replace_pairs):
-    """perform multiple text replace in line"""
-    with open(file_name) as reader:
-        lines = reader.readlines()
-
-    # find the line number contain pattern
-    linum = None
-    for i in range(len(lines)):
-        if re.search(pattern, lines[i]):
-            linum = i
+    backup_path = file_name + '_' + current_datetime + '.bak'
+
+    # create backup readable only by its owner before copying, so backup
+    # of a root only file is never readable by others, then give it the
+    # mode of file (e.g. 0440 which even the owner can not write into)
+    os.close(os.open(
+        backup_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600
+    ))
+    copy_file(file_name, backup_path)
+    shutil.copymode(file_name, backup_path)
+
+    # retention, only the newest backups of each file are kept
+    backups.append({'name': os.path.basename(backup_path), 'sha256': digest})
+    for entry in backups[:-keep]:
+        os.remove(os.path.join(dir_name, entry['name']))
+    manifest[os.path.basename(file_name)] = backups[-keep:]
+    save_json(manifest_path, manifest)
+
+    return backup_path
+
+
+class ConfigEditor:
+    """queue edits of a config file, apply them in one pass and commit"""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.line_operations = []
+        self.blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+    def replace_in_line(self, pattern, replace_pairs):
+        """perform multiple text replace in first line match pattern"""
+        self.line_operations.append(
+            ('replace', re.compile(pattern), replace_pairs)
+        )
+
+    def uncomment(self, pattern, following=0):
+        """uncomment lines match pattern and following lines after them"""
+        self.line_operations.append(
+            ('uncomment', re.compile(pattern), following)
+        )
+
+    def ensure_line(self, line, pattern=None, comment=None):
+        """replace line match pattern (or line itself) or append it"""
+        pattern = pattern or rf'^{re.escape(line)}$'
+        self.line_operations.append(
+            ('ensure', re.compile(pattern), (line, comment))
+        )
+
+    def append_block(self, block):
+        """append block of lines if file does not contain it yet"""
+        self.blocks.append(block)
+
+    def apply(self, lines):
+        """apply queued operations to lines, return new lines"""
+        # one regex decide whether a line need any operation at all
+        any_pattern = re.compile('|'.join(
+            f'(?:{pattern.pattern})' for _, pattern, _ in self.line_operations
+        )) if self.line_operations else None
+
+        new_lines = []
+        done = set()
+        uncomment_count = 0
+        for line in lines:
+            if uncomment_count:
+                line = re.sub(r'^(\s*)#\s?', r'\1', line)
+                uncomment_count -= 1
+
+            if any_pattern and any_pattern.search(line):
+                for index, (kind, pattern, argument) in enumerate(
+                    self.line_operations
+                ):
+                    if not pattern.search(line):
+                        continue
+
+                    if kind == 'replace' and index not in done:
+                        for old, new in argument:
+                            line = line.replace(old, new)
+                    elif kind == 'uncomment':
+                        line = re.sub(r'^(\s*)#\s?', r'\1', line)
+                        uncomment_count = argument
+                    elif kind == 'ensure' and index not in done:
+                        line = argument[0] + '\n'
+                    done.add(index)
+
+            new_lines.append(line)
+
+        # ensured lines not found and blocks not present are appended
+        content = ''.join(new_lines)
+        appends = []
+        for index, (kind, _, argument) in enumerate(self.line_operations):
+            if kind == 'ensure' and index not in done:
+                line, comment = argument
+                appends.append(
+                    (f'\n## {comment}\n' if comment else '') + line + '\n'
+                )
+        for block in self.blocks:
+            if block not in content and block not in appends:
+                appends.append(block)
+
+        if appends and content and not content.endswith('\n'):
+            content += '\n'
+
+        return (content + ''.join(appends)).splitlines(keepends=True)
+
+    def commit(self):
+        """write changes atomically, return whether file changed"""
+        with open(self.file_name) as reader:
+            lines = reader.readlines()
+
+        new_lines = self.apply(lines)
+        self.line_operations.clear()
+        self.blocks.clear()
+        if new_lines == lines:
+            return False
+
+        # keep owner and mode (e.g. sudoers must stay 0440)
+        temp_name = self.file_name + '.tmp'
+        stat = os.stat(self.file_name)
+        with open(temp_name, 'w') as writer:
+            writer.writelines(new_lines)
+            writer.flush()
+            os.fsync(writer.fileno())
+        os.chown(temp_name, stat.st_uid, stat.st_gid)
+        os.chmod(temp_name, stat.st_mode)
+        os.replace(temp_name, self.file_name)
+
+        return True
+
+
+class Throttle:
+    """limit aggregate throughput of copies running in several threads"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self.lock = threading.Lock()
+        self.available_at = time.monotonic()
+
+    def consume(self, size):
+        """wait until size bytes may be moved"""
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.available_at, now)
+            self.available_at = start + size / self.bytes_per_second
+
+        if start > now:
+            time.sleep(start - now)
+
+
+def punch_hole(fd, offset, length):
+    """deallocate a range of file, it is read back as zeros"""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.fallocate.argtypes = [
+        ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64
+    ]
+
+    if libc.fallocate(
+        fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length
+    ) != 0:
+        error_number = ctypes.get_errno()
+        raise OSError(error_number, os.strerror(error_number))
+
+
+def iter_data_segments(fd, size):
+    """iterate (start, end) of data segments of file, skip holes"""
+    offset = 0
+
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as error:
+            # nothing but hole until the end
+            if error.errno == errno.ENXIO:
+                return
+            raise
+
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end
+        offset = end
+
+
+class ChunkHasher:
+    """sha256 of each fixed size chunk of a file that is fed in order"""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.digests = []
+        self.offset = 0
+        self.digest = hashlib.sha256()
+        self.zero_digest = None
+
+    def update(self, data):
+        """hash data that follow what was fed so far"""
+        view = memoryview(data)
+        while view:
+            count = min(
+                len(view), self.chunk_size - self.offset % self.chunk_size
+            )
+            self.digest.update(view[:count])
+            self.offset += count
+            view = view[count:]
+
+            if self.offset % self.chunk_size == 0:
+                self.digests.append(self.digest.hexdigest())
+                self.digest = hashlib.sha256()
+
+    def skip_to(self, offset):
+        """hash zeros of a hole up to offset"""
+        while self.offset < offset:
+            # whole chunks of zeros all have the same digest
+            if self.offset % self.chunk_size == 0 and \
+                    offset - self.offset >= self.chunk_size:
+                if self.zero_digest is None:
+                    self.zero_digest = hashlib.sha256(
+                        bytes(self.chunk_size)
+                    ).hexdigest()
+                self.digests.append(self.zero_digest)
+                self.offset += self.chunk_size
+                continue
+
+            self.update(
+                ZERO_CHUNK[:min(COPY_CHUNK_SIZE, offset - self.offset)]
+            )
+
+    def finish(self, size):
+        """get digests of all chunks of file of size"""
+        self.skip_to(size)
+        if self.offset % self.chunk_size:
+            self.digests.append(self.digest.hexdigest())
+
+        return self.digests
+
+
+def copy_range(source_fd, destination_fd, start, end, stats, throttle=None,
+               hasher=None):
+    """copy a byte range in kernel, fallback to read/write"""
+    offset = start
+
+    # in-kernel copy never pass data through us, hashing need read/write
+    if stats['method'] == 'copy_file_range' and hasher is None:
+        try:
+            while offset < end:
+                count = min(COPY_CHUNK_SIZE, end - offset)
+                if throttle:
+                    throttle.consume(count)
+
+                copied = os.copy_file_range(
+                    source_fd, destination_fd, count, offset, offset
+                )
+                if copied == 0:
+                    break
+                offset += copied
+                stats['copied'] += copied
+        except OSError:
+            # e.g. cross filesystem copy on old kernel
+            stats['method'] = 'read/write'
+
+    while offset < end:
+        count = min(COPY_CHUNK_SIZE, end - offset)
+        if throttle:
+            throttle.consume(count)
+
+        chunk = os.pread(source_fd, count, offset)
+        if not chunk:
             break
 
-    # multiple replace in line
-    if linum:
-        for pair in replace_pairs:
-            lines[linum] = lines[linum].replace(pair[0], pair[1])
+        if hasher:
+            hasher.skip_to(offset)
+            hasher.update(chunk)
+
+        # zero chunk inside data segment is left as hole
+        if chunk != ZERO_CHUNK[:len(chunk)]:
+            os.pwrite(destination_fd, chunk, offset)
+            stats['copied'] += len(chunk)
+        else:
+            stats['holes'] += len(chunk)
+        offset += len(chunk)
+
+
+def copy_file(source, destination, throttle=None, hash_chunk_size=None):
+    """copy file with reflink, in-kernel copy or read/write, keep holes"""
+    # with hash_chunk_size, stats has 'digests' of chunks as they were
+    # copied (as hash_file_chunks would give), except for a reflink copy
+    # which share data of source and write nothing
+    with open(source, 'rb') as reader, open(destination, 'wb') as writer:
+        size = os.fstat(reader.fileno()).st_size
+        stats = {
+            'size': size, 'copied': 0, 'holes': 0, 'method': 'reflink'
+        }
+
+        try:
+            fcntl.ioctl(writer.fileno(), FICLONE, reader.fileno())
+            return stats
+        except OSError:
+            stats['method'] = 'copy_file_range'
+
+        hasher = None
+        if hash_chunk_size:
+            hasher = ChunkHasher(hash_chunk_size)
+            stats['method'] = 'read/write'
+
+        # set size first, so holes are never read or written
+        writer.truncate(size)
+        for start, end in iter_data_segments(reader.fileno(), size):
+            copy_range(
+                reader.fileno(), writer.fileno(), start, end, stats, throttle,
+                hasher
+            )
+
+        if hasher:
+            stats['digests'] = hasher.finish(size)
+
+    return stats
+
+
+def hash_file(file_name, chunk_size=1024 ** 2):
+    """get sha256 of file content"""
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as reader:
+        while chunk := reader.read(chunk_size):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def open_direct(file_name):
+    """open file for reading with direct I/O if possible"""
+    # O_DIRECT bypass the page cache, so we really read what is on disk,
+    # it need an aligned buffer (mmap is page aligned)
+    try:
+        return os.open(file_name, os.O_RDONLY | os.O_DIRECT)
+    except OSError:
+        # e.g. tmpfs does not support it
+        return os.open(file_name, os.O_RDONLY)
+
+
+def read_direct(fd, buffer, offset):
+    """fill page aligned buffer from offset, return length read"""
+    view = memoryview(buffer)
+    length = 0
+
+    try:
+        while length < len(view):
+            read = os.preadv(fd, [view[length:]], offset + length)
+            if read == 0:
+                break
+            length += read
+    finally:
+        view.release()
+
+    return length
+
+
+def hash_chunk(file_name, offset, chunk_size):
+    """get sha256 of a chunk of file, read with direct I/O if possible"""
+    fd = open_direct(file_name)
+
+    try:
+        with mmap.mmap(-1, chunk_size) as buffer:
+            length = read_direct(fd, buffer, offset)
+            with memoryview(buffer) as view:
+                return hashlib.sha256(view[:length]).hexdigest()
+    finally:
+        os.close(fd)
+
+
+def hash_file_chunks(file_name, chunk_size=HASH_CHUNK_SIZE):
+    """get sha256 of each chunk of file, chunks are hashed in parallel"""
+    size = os.path.getsize(file_name)
+
+    with ThreadPoolExecutor(os.cpu_count()) as executor:
+        return list(executor.map(
+            lambda offset: hash_chunk(file_name, offset, chunk_size),
+            range(0, size, chunk_size)
+        ))
+
+
+def build_manifest(path_to_dir, old_files=None):
+    """get size, mtime and sha256 of every file in directory"""
+    old_files = old_files or {}
+    files = {}
+
+    for root, dir_names, file_names in os.walk(path_to_dir):
+        dir_names.sort()
+        for dir_name in dir_names:
+            path = os.path.relpath(os.path.join(root, dir_name), path_to_dir)
+            files[path] = {'is_dir': True}
+
+        for file_name in sorted(file_names):
+            full_path = os.path.join(root, file_name)
+            path = os.path.relpath(full_path, path_to_dir)
+            stat = os.stat(full_path)
+            info = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+            # unchanged size and mtime, reuse hash instead of reading file
+            old_info = old_files.get(path, {})
+            if all(old_info.get(key) == info[key] for key in info):
+                info['sha256'] = old_info['sha256']
+            else:
+                info['sha256'] = hash_file(full_path)
+
+            files[path] = info
+
+    return files
+
+
+def load_json(file_name):
+    """load json file, None if it does not exist"""
+    try:
+        with open(file_name) as reader:
+            return json.load(reader)
+    except FileNotFoundError:
+        return None
+
+
+def save_json(file_name, data):
+    """save data to json file atomically"""
+    with open(file_name + '.tmp', 'w') as writer:
+        json.dump(data, writer, indent=4)
 
-    # save modified file
-    with open(file_name, 'w') as writer:
-        writer.writelines(lines)
+    os.replace(file_name + '.tmp', file_name)
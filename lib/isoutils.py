@@ -0,0 +1,962 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+import binascii
+import mmap
+import os
+import struct
+import time
+
+from lib import fileutils
+
+SECTOR_SIZE = 2048
+
+# ISO9660 volume descriptor types
+BOOT_RECORD = 0
+PRIMARY_VOLUME_DESCRIPTOR = 1
+SUPPLEMENTARY_VOLUME_DESCRIPTOR = 2
+VOLUME_DESCRIPTOR_SET_TERMINATOR = 255
+
+# UDF descriptor tag identifiers
+UDF_ANCHOR_VOLUME_DESCRIPTOR_POINTER = 2
+UDF_PARTITION_DESCRIPTOR = 5
+UDF_LOGICAL_VOLUME_DESCRIPTOR = 6
+UDF_TERMINATING_DESCRIPTOR = 8
+UDF_LOGICAL_VOLUME_INTEGRITY_DESCRIPTOR = 9
+UDF_FILE_SET_DESCRIPTOR = 256
+UDF_FILE_IDENTIFIER_DESCRIPTOR = 257
+UDF_FILE_ENTRY = 261
+UDF_EXTENDED_FILE_ENTRY = 266
+
+EL_TORITO_PLATFORMS = {0x00: 'x86', 0x01: 'ppc', 0x02: 'mac', 0xef: 'efi'}
+
+
+def open_image(path_to_iso):
+    """map the whole image read-only into memory"""
+    with open(path_to_iso, 'rb') as reader:
+        return mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_sector(image, sector, count=1):
+    """read sector(s) from image"""
+    start = sector * SECTOR_SIZE
+    return image[start:start + count * SECTOR_SIZE]
+
+
+def get_volume_descriptors(image):
+    """get ISO9660 volume descriptors (sector 16 until terminator)"""
+    descriptors = {'supplementary': []}
+    sector = 16
+
+    while (sector + 1) * SECTOR_SIZE <= len(image):
+        descriptor = read_sector(image, sector)
+        if descriptor[1:6] != b'CD001':
+            break
+
+        descriptor_type = descriptor[0]
+        if descriptor_type == BOOT_RECORD:
+            descriptors['boot_record'] = descriptor
+            descriptors['boot_record_sector'] = sector
+        elif descriptor_type == PRIMARY_VOLUME_DESCRIPTOR:
+            descriptors['primary'] = descriptor
+            descriptors['primary_sector'] = sector
+        elif descriptor_type == SUPPLEMENTARY_VOLUME_DESCRIPTOR:
+            descriptors['supplementary'].append((sector, descriptor))
+        elif descriptor_type == VOLUME_DESCRIPTOR_SET_TERMINATOR:
+            break
+
+        sector += 1
+
+    if 'primary' not in descriptors:
+        raise ValueError('not an ISO9660 image (no primary volume descriptor)')
+
+    return descriptors
+
+
+def get_volume_id(image):
+    """get volume id from primary volume descriptor"""
+    primary = get_volume_descriptors(image)['primary']
+    return primary[40:72].decode('ascii', 'replace').strip()
+
+
+def get_volume_space_size(image):
+    """get number of sectors recorded in primary volume descriptor"""
+    primary = get_volume_descriptors(image)['primary']
+    return struct.unpack_from('<I', primary, 80)[0]
+
+
+def get_boot_entries(image):
+    """get boot entries from El Torito boot catalog"""
+    boot_record = get_volume_descriptors(image).get('boot_record')
+    if not boot_record or \
+            not boot_record[7:39].startswith(b'EL TORITO SPECIFICATION'):
+        return []
+
+    catalog_sector = struct.unpack_from('<I', boot_record, 71)[0]
+    catalog = read_sector(image, catalog_sector)
+
+    # validation entry must end with 0x55 0xaa
+    if catalog[0] != 1 or catalog[30:32] != b'\x55\xaa':
+        raise ValueError('invalid El Torito validation entry')
+
+    entries = [parse_boot_entry(catalog[32:64], catalog[1])]
+
+    # section headers (0x90, last one is 0x91) follow the default entry
+    offset = 64
+    while offset + 32 <= len(catalog) and catalog[offset] in (0x90, 0x91):
+        platform_id = catalog[offset + 1]
+        entry_count = struct.unpack_from('<H', catalog, offset + 2)[0]
+        is_last_section = catalog[offset] == 0x91
+        offset += 32
+
+        for _ in range(entry_count):
+            entries.append(
+                parse_boot_entry(catalog[offset:offset + 32], platform_id)
+            )
+            offset += 32
+
+        if is_last_section:
+            break
+
+    return entries
+
+
+def parse_boot_entry(entry, platform_id):
+    """parse an El Torito initial/section entry"""
+    return {
+        'platform': EL_TORITO_PLATFORMS.get(platform_id, hex(platform_id)),
+        'bootable': entry[0] == 0x88,
+        'media_type': entry[1] & 0x0f,
+        'sector_count': struct.unpack_from('<H', entry, 6)[0],
+        'load_rba': struct.unpack_from('<I', entry, 8)[0]
+    }
+
+
+def iter_directory_records(image, extent, size):
+    """iterate ISO9660 directory records of a directory extent"""
+    data = image[extent * SECTOR_SIZE:extent * SECTOR_SIZE + size]
+    offset = 0
+
+    while offset < len(data):
+        record_length = data[offset]
+
+        # records do not cross sector boundary, zero means padding
+        if record_length == 0:
+            offset = (offset // SECTOR_SIZE + 1) * SECTOR_SIZE
+            continue
+
+        yield offset, data[offset:offset + record_length]
+        offset += record_length
+
+
+def parse_directory_record(record, is_joliet=False):
+    """parse an ISO9660 directory record"""
+    name_length = record[32]
+    raw_name = record[33:33 + name_length]
+
+    if raw_name in (b'\x00', b'\x01'):
+        name = None
+    elif is_joliet:
+        name = raw_name.decode('utf-16-be').split(';')[0]
+    else:
+        name = raw_name.decode('ascii', 'replace').split(';')[0]
+        if name.endswith('.'):
+            name = name[:-1]
+
+    return {
+        'name': name,
+        'extent': struct.unpack_from('<I', record, 2)[0],
+        'size': struct.unpack_from('<I', record, 10)[0],
+        'is_dir': bool(record[25] & 0x02),
+        'is_multi_extent': bool(record[25] & 0x80)
+    }
+
+
+def list_iso9660_files(image, descriptor=None, is_joliet=False):
+    """list files of ISO9660 (or Joliet) directory tree"""
+    if descriptor is None:
+        descriptor = get_volume_descriptors(image)['primary']
+
+    root = parse_directory_record(descriptor[156:190])
+    files = []
+    directories = [('', root['extent'], root['size'])]
+
+    while directories:
+        parent, extent, size = directories.pop()
+        previous = None
+
+        for _, record in iter_directory_records(image, extent, size):
+            entry = parse_directory_record(record, is_joliet)
+            if entry['name'] is None:
+                continue
+
+            path = f'{parent}/{entry["name"]}'
+
+            # a file bigger than 4 GiB is split in several records
+            if previous and previous['path'] == path:
+                previous['size'] += entry['size']
+                previous['extents'].append(
+                    (entry['extent'] * SECTOR_SIZE, entry['size'])
+                )
+                continue
+
+            previous = {
+                'path': path,
+                'size': entry['size'],
+                'is_dir': entry['is_dir'],
+                'extents': [(entry['extent'] * SECTOR_SIZE, entry['size'])]
+            }
+            files.append(previous)
+
+            if entry['is_dir']:
+                directories.append((path, entry['extent'], entry['size']))
+
+    return sorted(files, key=lambda file: file['path'])
+
+
+def get_joliet_descriptor(image):
+    """get Joliet supplementary volume descriptor if any"""
+    for _, descriptor in get_volume_descriptors(image)['supplementary']:
+        # escape sequences for UCS-2 level 1, 2, 3
+        if descriptor[88:91] in (b'%/@', b'%/C', b'%/E'):
+            return descriptor
+
+    return None
+
+
+def decode_dstring(data):
+    """decode an OSTA CS0 compressed unicode string"""
+    if not data:
+        return ''
+
+    if data[0] == 8:
+        return data[1:].decode('latin-1')
+
+    if data[0] == 16:
+        return data[1:].decode('utf-16-be')
+
+    raise ValueError(f'unknown OSTA compression id {data[0]}')
+
+
+def is_udf_tag(descriptor, tag_id, location):
+    """check UDF descriptor tag identifier, checksum and location"""
+    if len(descriptor) < 16:
+        return False
+
+    checksum = (sum(descriptor[:4]) + sum(descriptor[5:16])) & 0xff
+
+    return (
+        struct.unpack_from('<H', descriptor)[0] == tag_id and
+        descriptor[4] == checksum and
+        struct.unpack_from('<I', descriptor, 12)[0] == location
+    )
+
+
+def get_udf_volume(image):
+    """get UDF partitions and file set location, None if no UDF"""
+    anchor = read_sector(image, 256)
+    if not is_udf_tag(anchor, UDF_ANCHOR_VOLUME_DESCRIPTOR_POINTER, 256):
+        return None
+
+    last_sector = len(image) // SECTOR_SIZE - 1
+    partitions = {}
+    partition_maps = []
+    volume = {
+        'anchor_sectors': [
+            sector for sector in (256, last_sector - 256, last_sector)
+            if is_udf_tag(
+                read_sector(image, sector),
+                UDF_ANCHOR_VOLUME_DESCRIPTOR_POINTER, sector
+            )
+        ],
+        'partition_descriptors': []
+    }
+
+    main_sequence = struct.unpack_from('<II', anchor, 16)
+    reserve_sequence = struct.unpack_from('<II', anchor, 24)
+
+    for length, location in (main_sequence, reserve_sequence):
+        for sector in range(location, location + length // SECTOR_SIZE):
+            descriptor = read_sector(image, sector)
+            tag_id = struct.unpack_from('<H', descriptor)[0]
+
+            if tag_id == UDF_PARTITION_DESCRIPTOR:
+                number = struct.unpack_from('<H', descriptor, 22)[0]
+                partitions.setdefault(
+                    number, struct.unpack_from('<II', descriptor, 188)
+                )
+                volume['partition_descriptors'].append(sector)
+            elif tag_id == UDF_LOGICAL_VOLUME_DESCRIPTOR and \
+                    'file_set' not in volume:
+                partition_maps = parse_logical_volume_descriptor(
+                    descriptor, volume
+                )
+            elif tag_id == UDF_TERMINATING_DESCRIPTOR:
+                break
+
+    volume['partition_starts'] = [
+        partitions[number][0] for number in partition_maps
+    ]
+    volume['partition_lengths'] = [
+        partitions[number][1] for number in partition_maps
+    ]
+    volume['partition_numbers'] = partition_maps
+
+    return volume
+
+
+def parse_logical_volume_descriptor(descriptor, volume):
+    """get file set and integrity location, return partition map"""
+    block_size = struct.unpack_from('<I', descriptor, 212)[0]
+    if block_size != SECTOR_SIZE:
+        raise ValueError(f'unsupported UDF block size {block_size}')
+
+    volume['file_set'] = struct.unpack_from('<IH', descriptor, 252)
+    volume['integrity_sector'] = struct.unpack_from('<I', descriptor, 436)[0]
+
+    partition_maps = []
+    map_count = struct.unpack_from('<I', descriptor, 268)[0]
+    offset = 440
+    for _ in range(map_count):
+        map_type, map_length = descriptor[offset:offset + 2]
+        if map_type != 1:
+            raise ValueError('only type 1 UDF partition map supported')
+
+        partition_maps.append(
+            struct.unpack_from('<H', descriptor, offset + 4)[0]
+        )
+        offset += map_length
+
+    return partition_maps
+
+
+def udf_block_offset(volume, block, partition=0):
+    """convert UDF logical block address to byte offset in image"""
+    return (volume['partition_starts'][partition] + block) * SECTOR_SIZE
+
+
+def read_udf_file_entry(image, volume, block, partition=0):
+    """read UDF (extended) file entry, resolve its allocation"""
+    offset = udf_block_offset(volume, block, partition)
+    entry = image[offset:offset + SECTOR_SIZE]
+    tag_id = struct.unpack_from('<H', entry)[0]
+
+    if tag_id == UDF_FILE_ENTRY:
+        ea_length_offset = 168
+    elif tag_id == UDF_EXTENDED_FILE_ENTRY:
+        ea_length_offset = 208
+    else:
+        raise ValueError(f'expected UDF file entry at block {block}')
+
+    ea_length, ad_length = struct.unpack_from('<II', entry, ea_length_offset)
+    ad_start = ea_length_offset + 8 + ea_length
+    allocation_type = struct.unpack_from('<H', entry, 34)[0] & 0x07
+    size = struct.unpack_from('<Q', entry, 56)[0]
+    extents = []
+
+    if allocation_type == 0:
+        # short_ad, extents are in the same partition as the entry
+        for ad in range(ad_start, ad_start + ad_length, 8):
+            length, position = struct.unpack_from('<II', entry, ad)
+            if length & 0x3fffffff:
+                extents.append((
+                    udf_block_offset(volume, position, partition),
+                    length & 0x3fffffff
+                ))
+    elif allocation_type == 1:
+        for ad in range(ad_start, ad_start + ad_length, 16):
+            length, position, ad_partition = struct.unpack_from(
+                '<IIH', entry, ad
+            )
+            if length & 0x3fffffff:
+                extents.append((
+                    udf_block_offset(volume, position, ad_partition),
+                    length & 0x3fffffff
+                ))
+    elif allocation_type == 3:
+        # data embedded in the entry itself
+        extents.append((offset + ad_start, ad_length))
+    else:
+        raise ValueError(f'unsupported UDF allocation type {allocation_type}')
+
+    return {
+        'offset': offset,
+        'file_type': entry[27],
+        'size': size,
+        'extents': extents,
+        'allocation_type': allocation_type,
+        'ad_start': ad_start,
+        'ad_length': ad_length
+    }
+
+
+def read_extents(image, extents, size):
+    """read data described by extents"""
+    data = b''.join(image[start:start + length] for start, length in extents)
+    return data[:size]
+
+
+def iter_file_identifiers(data):
+    """iterate UDF file identifier descriptors of directory data"""
+    offset = 0
+
+    while offset + 38 <= len(data):
+        tag_id = struct.unpack_from('<H', data, offset)[0]
+        if tag_id != UDF_FILE_IDENTIFIER_DESCRIPTOR:
+            break
+
+        characteristics, name_length = data[offset + 18:offset + 20]
+        entry_length, block, partition = struct.unpack_from(
+            '<IIH', data, offset + 20
+        )
+        iu_length = struct.unpack_from('<H', data, offset + 36)[0]
+        name_start = offset + 38 + iu_length
+        length = (38 + iu_length + name_length + 3) & ~3
+
+        yield {
+            'offset': offset,
+            'length': length,
+            'name': decode_dstring(data[name_start:name_start + name_length]),
+            'is_dir': bool(characteristics & 0x02),
+            'is_deleted': bool(characteristics & 0x04),
+            'is_parent': bool(characteristics & 0x08),
+            'block': block,
+            'partition': partition
+        }
+
+        offset += length
+
+
+def list_udf_files(image, volume=None):
+    """list files of UDF directory tree"""
+    if volume is None:
+        volume = get_udf_volume(image)
+
+    block, partition = volume['file_set']
+    file_set_offset = udf_block_offset(volume, block, partition)
+    file_set = image[file_set_offset:file_set_offset + SECTOR_SIZE]
+    if struct.unpack_from('<H', file_set)[0] != UDF_FILE_SET_DESCRIPTOR:
+        raise ValueError('UDF file set descriptor not found')
+
+    root = struct.unpack_from('<IH', file_set, 404)
+    files = []
+    directories = [('', root)]
+
+    while directories:
+        parent, (block, partition) = directories.pop()
+        directory = read_udf_file_entry(image, volume, block, partition)
+        data = read_extents(image, directory['extents'], directory['size'])
+
+        for identifier in iter_file_identifiers(data):
+            if identifier['is_parent'] or identifier['is_deleted']:
+                continue
+
+            path = f'{parent}/{identifier["name"]}'
+            location = (identifier['block'], identifier['partition'])
+            entry = read_udf_file_entry(image, volume, *location)
+            files.append({
+                'path': path,
+                'size': entry['size'],
+                'is_dir': identifier['is_dir'],
+                'extents': entry['extents']
+            })
+
+            if identifier['is_dir']:
+                directories.append((path, location))
+
+    return sorted(files, key=lambda file: file['path'])
+
+
+def list_files(image):
+    """list files, prefer UDF then Joliet then plain ISO9660 tree"""
+    volume = get_udf_volume(image)
+    if volume:
+        return list_udf_files(image, volume)
+
+    joliet = get_joliet_descriptor(image)
+    if joliet:
+        return list_iso9660_files(image, joliet, is_joliet=True)
+
+    return list_iso9660_files(image)
+
+
+def inspect_iso(path_to_iso):
+    """get volume id, boot entries and file listing of an ISO"""
+    with open_image(path_to_iso) as image:
+        return {
+            'volume_id': get_volume_id(image),
+            'is_udf': get_udf_volume(image) is not None,
+            'boot_entries': get_boot_entries(image),
+            'files': list_files(image)
+        }
+
+
+def sectors_for(size):
+    """number of sectors needed to store size bytes"""
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+def update_udf_tag(descriptor, location=None):
+    """recompute UDF tag CRC and checksum after descriptor changed"""
+    if location is not None:
+        struct.pack_into('<I', descriptor, 12, location)
+
+    crc_length = struct.unpack_from('<H', descriptor, 10)[0]
+    crc = binascii.crc_hqx(bytes(descriptor[16:16 + crc_length]), 0)
+    struct.pack_into('<H', descriptor, 8, crc)
+    descriptor[4] = (sum(descriptor[:4]) + sum(descriptor[5:16])) & 0xff
+
+    return descriptor
+
+
+def encode_dstring(name):
+    """encode name as OSTA CS0 compressed unicode"""
+    try:
+        return b'\x08' + name.encode('latin-1')
+    except UnicodeEncodeError:
+        return b'\x10' + name.encode('utf-16-be')
+
+
+def find_udf_entry(image, volume, path):
+    """find file entry location of path (case insensitive) in UDF tree"""
+    block, partition = volume['file_set']
+    file_set_offset = udf_block_offset(volume, block, partition)
+    location = struct.unpack_from('<IH', image, file_set_offset + 404)
+
+    for name in filter(None, path.split('/')):
+        directory = read_udf_file_entry(image, volume, *location)
+        data = read_extents(image, directory['extents'], directory['size'])
+
+        for identifier in iter_file_identifiers(data):
+            if not (identifier['is_parent'] or identifier['is_deleted']) \
+                    and identifier['name'].lower() == name.lower():
+                location = (identifier['block'], identifier['partition'])
+                break
+        else:
+            return None
+
+    return location
+
+
+# offsets of fields which differ between file entry and extended one
+UDF_FILE_ENTRY_FIELDS = {
+    UDF_FILE_ENTRY: {
+        'blocks_recorded': 64, 'extended_attribute_icb': 112,
+        'unique_id': 160, 'ea_length': 168
+    },
+    UDF_EXTENDED_FILE_ENTRY: {
+        'blocks_recorded': 72, 'extended_attribute_icb': 136,
+        'unique_id': 200, 'ea_length': 208
+    }
+}
+
+
+def set_udf_file_entry_extent(entry, block, size, ad_start=None):
+    """make (extended) file entry point to one short_ad extent"""
+    tag_id = struct.unpack_from('<H', entry)[0]
+    fields = UDF_FILE_ENTRY_FIELDS[tag_id]
+    if ad_start is None:
+        ea_length = struct.unpack_from('<I', entry, fields['ea_length'])[0]
+        ad_start = fields['ea_length'] + 8 + ea_length
+
+    # information length (and object size of extended file entry)
+    struct.pack_into('<Q', entry, 56, size)
+    if tag_id == UDF_EXTENDED_FILE_ENTRY:
+        struct.pack_into('<Q', entry, 64, size)
+    struct.pack_into('<Q', entry, fields['blocks_recorded'], sectors_for(size))
+
+    # allocation type 0 (short_ad) in ICB tag flags
+    flags = struct.unpack_from('<H', entry, 34)[0]
+    struct.pack_into('<H', entry, 34, flags & ~0x07)
+
+    struct.pack_into('<I', entry, fields['ea_length'] + 4, 8)
+    entry[ad_start:] = bytes(len(entry) - ad_start)
+    struct.pack_into('<II', entry, ad_start, size, block)
+    struct.pack_into('<H', entry, 10, ad_start + 8 - 16)
+
+    return entry
+
+
+def make_udf_file_entry(template, block, size, unique_id):
+    """make file entry of a regular file from a (directory) template"""
+    entry = bytearray(template)
+    tag_id = struct.unpack_from('<H', entry)[0]
+    fields = UDF_FILE_ENTRY_FIELDS[tag_id]
+
+    # regular file, one link, no execute permission
+    entry[27] = 5
+    struct.pack_into('<H', entry, 48, 1)
+    permissions = struct.unpack_from('<I', entry, 44)[0]
+    struct.pack_into('<I', entry, 44, permissions & ~0x421)
+
+    # no extended attributes (nor stream directory)
+    ea_icb = fields['extended_attribute_icb']
+    end_of_icbs = ea_icb + (32 if tag_id == UDF_EXTENDED_FILE_ENTRY else 16)
+    entry[ea_icb:end_of_icbs] = bytes(end_of_icbs - ea_icb)
+    struct.pack_into('<I', entry, fields['ea_length'], 0)
+    struct.pack_into('<Q', entry, fields['unique_id'], unique_id)
+
+    return set_udf_file_entry_extent(
+        entry, block, size, fields['ea_length'] + 8
+    )
+
+
+def make_udf_file_identifier(template, name, block, partition, unique_id):
+    """make file identifier descriptor like the template one"""
+    encoded_name = encode_dstring(name)
+    length = (38 + len(encoded_name) + 3) & ~3
+    identifier = bytearray(length)
+
+    # same tag version, serial and CRC length convention as template
+    identifier[0:8] = template[0:8]
+    crc_length = length - 16
+    if struct.unpack_from('<H', template, 10)[0] + 16 != len(template):
+        crc_length = 38 + len(encoded_name) - 16
+    struct.pack_into('<H', identifier, 10, crc_length)
+
+    struct.pack_into('<HBB', identifier, 16, 1, 0, len(encoded_name))
+    struct.pack_into('<IIH', identifier, 20, SECTOR_SIZE, block, partition)
+    struct.pack_into('<I', identifier, 32, unique_id & 0xffffffff)
+    identifier[38:38 + len(encoded_name)] = encoded_name
+
+    return identifier
+
+
+def relocate_udf_file_identifiers(data, block):
+    """fix tag location of identifiers when directory data is moved"""
+    for identifier in list(iter_file_identifiers(data)):
+        start = identifier['offset']
+        end = start + identifier['length']
+        location = block + start // SECTOR_SIZE
+        data[start:end] = update_udf_tag(bytearray(data[start:end]), location)
+
+    return data
+
+
+def add_file_to_udf_image(path_to_iso, iso_path, data):
+    """add (or replace) a file in UDF tree by appending new blocks"""
+    directory_path, name = iso_path.rsplit('/', 1)
+
+    with open_image(path_to_iso) as image:
+        volume = get_udf_volume(image)
+        if volume is None:
+            raise ValueError(f'{path_to_iso} has no UDF file system to patch')
+
+        directory_location = find_udf_entry(image, volume, directory_path)
+        if directory_location is None:
+            raise ValueError(f'directory {directory_path} not found')
+
+        directory_block, partition = directory_location
+        directory = read_udf_file_entry(image, volume, *directory_location)
+        directory_data = bytearray(
+            read_extents(image, directory['extents'], directory['size'])
+        )
+        directory_entry = bytearray(
+            image[directory['offset']:directory['offset'] + SECTOR_SIZE]
+        )
+        identifiers = list(iter_file_identifiers(directory_data))
+        existing = next((
+            identifier for identifier in identifiers
+            if not (identifier['is_parent'] or identifier['is_deleted']) and
+            identifier['name'].lower() == name.lower()
+        ), None)
+
+        integrity_sector = volume['integrity_sector']
+        integrity = bytearray(read_sector(image, integrity_sector))
+        if not is_udf_tag(
+            integrity, UDF_LOGICAL_VOLUME_INTEGRITY_DESCRIPTOR,
+            integrity_sector
+        ):
+            raise ValueError('UDF logical volume integrity not found')
+
+        if existing:
+            partition = existing['partition']
+            file_entry_offset = udf_block_offset(
+                volume, existing['block'], partition
+            )
+            file_entry = bytearray(
+                image[file_entry_offset:file_entry_offset + SECTOR_SIZE]
+            )
+
+        anchor = bytearray(read_sector(image, 256))
+        partition_descriptors = {
+            sector: bytearray(read_sector(image, sector))
+            for sector in volume['partition_descriptors']
+        }
+        descriptors = get_volume_descriptors(image)
+        volume_descriptors = {
+            sector: bytearray(descriptor)
+            for sector, descriptor in descriptors['supplementary']
+        }
+        volume_descriptors[descriptors['primary_sector']] = bytearray(
+            descriptors['primary']
+        )
+        image_sectors = sectors_for(len(image))
+
+    # layout of appended sectors: [file entry] data [directory] anchor
+    partition_start = volume['partition_starts'][partition]
+    next_sector = image_sectors
+    unique_id = struct.unpack_from('<Q', integrity, 40)[0]
+
+    if not existing:
+        file_entry_offset = next_sector * SECTOR_SIZE
+        next_sector += 1
+
+    data_sector = next_sector
+    next_sector += sectors_for(len(data))
+
+    if not existing:
+        template = identifiers[0]
+        identifier = make_udf_file_identifier(
+            directory_data[
+                template['offset']:template['offset'] + template['length']
+            ],
+            name, file_entry_offset // SECTOR_SIZE - partition_start,
+            partition, unique_id
+        )
+        directory_data += identifier
+        directory_sector = next_sector
+        next_sector += sectors_for(len(directory_data))
+
+    anchor_sector = next_sector
+    total_sectors = anchor_sector + 1
+    file_entry_block = file_entry_offset // SECTOR_SIZE - partition_start
+
+    if existing:
+        set_udf_file_entry_extent(
+            file_entry, data_sector - partition_start, len(data)
+        )
+    else:
+        file_entry = make_udf_file_entry(
+            directory_entry, data_sector - partition_start, len(data),
+            unique_id
+        )
+        struct.pack_into('<Q', integrity, 40, unique_id + 1)
+
+        directory_block_in_partition = directory_sector - partition_start
+        relocate_udf_file_identifiers(
+            directory_data, directory_block_in_partition
+        )
+        set_udf_file_entry_extent(
+            directory_entry, directory_block_in_partition,
+            len(directory_data)
+        )
+        update_udf_tag(directory_entry, directory_block)
+
+    update_udf_tag(file_entry, file_entry_block)
+
+    # grow partition over appended sectors (all but the new anchor)
+    partition_length = anchor_sector - partition_start
+    partition_count = struct.unpack_from('<I', integrity, 72)[0]
+    struct.pack_into(
+        '<I', integrity, 80 + 4 * partition_count + 4 * partition,
+        partition_length
+    )
+
+    # number of files in implementation use after free space, size tables
+    files_offset = 80 + 8 * partition_count + 32
+    if not existing and \
+            struct.unpack_from('<I', integrity, 76)[0] >= 40:
+        files = struct.unpack_from('<I', integrity, files_offset)[0]
+        struct.pack_into('<I', integrity, files_offset, files + 1)
+
+    update_udf_tag(integrity)
+
+    partition_number = volume['partition_numbers'][partition]
+    for descriptor in partition_descriptors.values():
+        if struct.unpack_from('<H', descriptor, 22)[0] == partition_number:
+            struct.pack_into('<I', descriptor, 192, partition_length)
+            update_udf_tag(descriptor)
+
+    for descriptor in volume_descriptors.values():
+        struct.pack_into('<I', descriptor, 80, total_sectors)
+        struct.pack_into('>I', descriptor, 84, total_sectors)
+
+    update_udf_tag(anchor, anchor_sector)
+
+    fd = os.open(path_to_iso, os.O_RDWR)
+    try:
+        os.ftruncate(fd, total_sectors * SECTOR_SIZE)
+        os.pwrite(fd, data, data_sector * SECTOR_SIZE)
+        os.pwrite(fd, file_entry, file_entry_offset)
+
+        if not existing:
+            os.pwrite(fd, directory_data, directory_sector * SECTOR_SIZE)
+            os.pwrite(fd, directory_entry, directory['offset'])
+
+        os.pwrite(fd, integrity, integrity_sector * SECTOR_SIZE)
+        for sector, descriptor in partition_descriptors.items():
+            os.pwrite(fd, descriptor, sector * SECTOR_SIZE)
+
+        for sector, descriptor in volume_descriptors.items():
+            os.pwrite(fd, descriptor, sector * SECTOR_SIZE)
+
+        os.pwrite(fd, anchor, anchor_sector * SECTOR_SIZE)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def patch_iso(path_to_iso, path_to_new_iso, files):
+    """make new ISO with added files, reuse all original extents"""
+    fileutils.copy_file(path_to_iso, path_to_new_iso)
+
+    for iso_path, data in files.items():
+        add_file_to_udf_image(path_to_new_iso, iso_path, data)
+
+
+def find_iso9660_records(image, extent):
+    """find offsets of file records using extent in all ISO9660 trees"""
+    descriptors = get_volume_descriptors(image)
+    trees = [descriptors['primary']] + [
+        descriptor for _, descriptor in descriptors['supplementary']
+    ]
+    offsets = []
+
+    for descriptor in trees:
+        root = parse_directory_record(descriptor[156:190])
+        directories = [(root['extent'], root['size'])]
+        visited = set()
+
+        while directories:
+            directory = directories.pop()
+            if directory in visited:
+                continue
+            visited.add(directory)
+
+            for offset, record in iter_directory_records(image, *directory):
+                entry = parse_directory_record(record)
+                if entry['name'] is None:
+                    continue
+
+                if entry['is_dir']:
+                    directories.append((entry['extent'], entry['size']))
+                elif entry['extent'] == extent:
+                    offsets.append(directory[0] * SECTOR_SIZE + offset)
+
+    return offsets
+
+
+def make_recording_date(timestamp):
+    """make 7 bytes ISO9660 recording date (UTC)"""
+    date = time.gmtime(timestamp)
+    return bytes([
+        date.tm_year - 1900, date.tm_mon, date.tm_mday,
+        date.tm_hour, date.tm_min, date.tm_sec, 0
+    ])
+
+
+def make_long_date(timestamp):
+    """make 17 bytes ISO9660 dec-datetime (UTC)"""
+    date = time.strftime('%Y%m%d%H%M%S00', time.gmtime(timestamp))
+    return date.encode() + b'\x00'
+
+
+def iter_susp_entries(record):
+    """iterate (offset, signature) of SUSP entries of a directory record"""
+    # system use area follow the name and its padding byte
+    name_length = record[32]
+    offset = 33 + name_length + (0 if name_length % 2 else 1)
+
+    while offset + 4 <= len(record):
+        length = record[offset + 2]
+        if length < 4:
+            break
+
+        yield offset, record[offset:offset + 2]
+        offset += length
+
+
+def find_rock_ridge_times(record):
+    """find (offset, is_long) of modify, access and change times in TF"""
+    times = []
+
+    # TF in continuation areas (CE) is not handled, mkisofs never put it
+    # there for a file
+    for offset, signature in iter_susp_entries(record):
+        if signature != b'TF':
+            continue
+
+        flags = record[offset + 4]
+        is_long = bool(flags & 0x80)
+        position = offset + 5
+        for bit in range(7):
+            if not flags & (1 << bit):
+                continue
+
+            # 1 modify, 2 access, 3 attributes (change) time
+            if bit in (1, 2, 3):
+                times.append((position, is_long))
+            position += 17 if is_long else 7
+
+    return times
+
+
+def update_iso9660_files(path_to_iso, files):
+    """overwrite data of files in place, False if a file doesn't fit"""
+    updates = []
+
+    with open_image(path_to_iso) as image:
+        joliet = get_joliet_descriptor(image)
+        if joliet is None:
+            return False
+
+        old_files = {
+            file['path']: file
+            for file in list_iso9660_files(image, joliet, is_joliet=True)
+        }
+
+        for iso_path, path_to_file in files.items():
+            old_file = old_files.get(iso_path)
+            size = os.path.getsize(path_to_file)
+
+            # new content must fit in sectors already allocated to the file
+            if old_file is None or old_file['is_dir'] or \
+                    len(old_file['extents']) != 1 or old_file['size'] == 0 or \
+                    sectors_for(size) > sectors_for(old_file['size']):
+                return False
+
+            start = old_file['extents'][0][0]
+            record_offsets = find_iso9660_records(image, start // SECTOR_SIZE)
+            rock_ridge_times = [
+                (record_offset + offset, is_long)
+                for record_offset in record_offsets
+                for offset, is_long in find_rock_ridge_times(
+                    image[record_offset:record_offset + image[record_offset]]
+                )
+            ]
+            updates.append((
+                path_to_file, start, size, sectors_for(old_file['size']),
+                record_offsets, rock_ridge_times
+            ))
+
+    fd = os.open(path_to_iso, os.O_RDWR)
+    try:
+        for update in updates:
+            path_to_file, start, size, sectors, record_offsets, \
+                rock_ridge_times = update
+            with open(path_to_file, 'rb') as reader:
+                data = reader.read()
+
+            os.pwrite(
+                fd, data + bytes(sectors * SECTOR_SIZE - len(data)), start
+            )
+
+            mtime = os.path.getmtime(path_to_file)
+            date = make_recording_date(mtime)
+            for offset in record_offsets:
+                os.pwrite(fd, struct.pack('<I', size), offset + 10)
+                os.pwrite(fd, struct.pack('>I', size), offset + 14)
+                os.pwrite(fd, date, offset + 18)
+
+            # Linux show Rock Ridge times when ISO has them
+            for offset, is_long in rock_ridge_times:
+                os.pwrite(
+                    fd, make_long_date(mtime) if is_long else date, offset
+                )
+
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    return True
@@ -0,0 +1,225 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+import os
+import secrets
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+IMAGES_DIR = '/var/lib/libvirt/images'
+
+# can be pointed to a stand-in script for testing
+VIRSH = os.environ.get('VIRSH', 'virsh')
+VIRSH_SESSIONS = 4
+
+
+def run_as_root():
+    """re-run current script with sudo if not root"""
+    if os.geteuid() != 0:
+        # sudo reset environment, keep stand-in virsh of caller
+        preserve_env = (
+            ['--preserve-env=VIRSH'] if 'VIRSH' in os.environ else []
+        )
+        os.execvp(
+            'sudo', ['sudo'] + preserve_env + [sys.executable] + sys.argv
+        )
+
+
+def get_normal_user():
+    """get name of user who run the script (through sudo)"""
+    return os.environ.get('SUDO_USER') or os.environ.get('USER', 'root')
+
+
+def print_copy_stats(stats):
+    """print bytes actually moved versus logical size"""
+    size_in_gib = stats['size'] / 1024 ** 3
+    copied_in_gib = stats['copied'] / 1024 ** 3
+    holes_in_gib = stats['holes'] / 1024 ** 3
+    print(
+        f'Copied {copied_in_gib:.2f} GiB of {size_in_gib:.2f} GiB, ' +
+        f'{holes_in_gib:.2f} GiB of zeros left as holes ({stats["method"]})'
+    )
+
+
+def convert_to_preallocated(source, destination):
+    """convert qcow2 image to preallocated metadata layout"""
+    # qemu-img can not convert an image onto itself
+    temp_path = destination + '.converting'
+    subprocess.run([
+        'qemu-img', 'convert', '-O', 'qcow2',
+        '-o', 'preallocation=metadata',
+        source, temp_path
+    ], check=True)
+    os.replace(temp_path, destination)
+
+
+def chown_tree(path, user):
+    """change owner of directory tree to user"""
+    shutil.chown(path, user, user)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            shutil.chown(os.path.join(root, name), user, user)
+
+
+def run_virsh(commands):
+    """run virsh commands in one session, return output of each command"""
+    # virsh print nothing between commands, mark end of each output
+    marker = f'end-of-output-{secrets.token_hex(8)}'
+    script = ' ; '.join(
+        f'{shlex.join(command)} ; echo {marker}' for command in commands
+    )
+
+    result = subprocess.run(
+        [VIRSH, script], capture_output=True, text=True
+    )
+
+    # virsh keep running after a failed command
+    errors = [
+        line for line in result.stderr.splitlines()
+        if line.startswith('error:')
+    ]
+    if errors:
+        raise RuntimeError('\n'.join(errors))
+
+    return result.stdout.split(f'{marker}\n')[:len(commands)]
+
+
+def dump_snapshot_xmls(vm_name, snapshots):
+    """get XML of snapshots, using a few virsh sessions at once"""
+    if not snapshots:
+        return {}
+
+    session_count = min(VIRSH_SESSIONS, len(snapshots))
+    batches = [snapshots[i::session_count] for i in range(session_count)]
+
+    with ThreadPoolExecutor(session_count) as executor:
+        outputs = executor.map(
+            lambda batch: run_virsh([
+                ['snapshot-dumpxml', vm_name, snapshot] for snapshot in batch
+            ]),
+            batches
+        )
+
+        xmls = {}
+        for batch, batch_xmls in zip(batches, outputs):
+            xmls.update(zip(batch, batch_xmls))
+
+    return xmls
+
+
+def get_vm_state(vm_name):
+    """get state of VM (running, shut off, paused, ...)"""
+    return run_virsh([['domstate', vm_name]])[0].strip()
+
+
+def get_vm_disks(vm_name):
+    """get source file of each disk of VM, keyed by target (vda, ...)"""
+    output = run_virsh([['domblklist', '--details', vm_name]])[0]
+
+    # skip header and separator lines
+    disks = {}
+    for line in output.splitlines()[2:]:
+        fields = line.split(None, 3)
+        if len(fields) == 4 and fields[1] == 'disk':
+            disks[fields[2]] = fields[3]
+
+    return disks
+
+
+@contextmanager
+def redirect_disk_writes(vm_name, path_to_image):
+    """send guest writes to a temporary overlay while image is read"""
+    # overlay is committed back on exit, yielded dict get the time guest's
+    # I/O was redirected
+    disks = get_vm_disks(vm_name)
+    targets = [
+        target for target, source in disks.items() if source == path_to_image
+    ]
+    if not targets:
+        raise ValueError(f'{path_to_image} is not a disk of {vm_name}')
+
+    target = targets[0]
+    overlay = f'{os.path.splitext(path_to_image)[0]}.backup-overlay.qcow2'
+    diskspecs = ['--diskspec', f'{target},file={overlay}']
+    for other_target in disks:
+        if other_target != target:
+            diskspecs += ['--diskspec', f'{other_target},snapshot=no']
+
+    redirect = {'seconds': 0.0}
+    start = time.monotonic()
+    run_virsh([[
+        'snapshot-create-as', vm_name, f'backup-{int(time.time())}',
+        '--disk-only', '--atomic', '--no-metadata'
+    ] + diskspecs])
+
+    try:
+        yield redirect
+    finally:
+        run_virsh([[
+            'blockcommit', vm_name, target, '--active', '--pivot', '--wait'
+        ]])
+        redirect['seconds'] = time.monotonic() - start
+        os.remove(overlay)
+
+
+def run_largest_first(tasks, queue_depth, run):
+    """run tasks concurrently, largest first, at most queue_depth per device"""
+    # task is a dict with 'size' and 'devices' (st_dev of devices it read
+    # or write), return (task, result or exception) in finish order
+    if queue_depth < 1:
+        raise ValueError('queue depth must be at least 1')
+
+    pending = sorted(tasks, key=lambda task: task['size'], reverse=True)
+    running = Counter()
+    condition = threading.Condition()
+    results = []
+    threads = []
+
+    def worker(task):
+        try:
+            result = run(task)
+        except Exception as error:
+            result = error
+
+        with condition:
+            results.append((task, result))
+            for device in task['devices']:
+                running[device] -= 1
+            condition.notify()
+
+    with condition:
+        while pending:
+            # largest task whose devices are not busy
+            task = next(
+                (
+                    task for task in pending
+                    if all(
+                        running[device] < queue_depth
+                        for device in task['devices']
+                    )
+                ),
+                None
+            )
+            if task is None:
+                condition.wait()
+                continue
+
+            pending.remove(task)
+            for device in task['devices']:
+                running[device] += 1
+
+            thread = threading.Thread(target=worker, args=(task,))
+            thread.start()
+            threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    return results
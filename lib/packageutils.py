@@ -0,0 +1,177 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+import glob
+import os
+import re
+import subprocess
+
+from lib import fileutils
+
+MANIFEST_CACHE = '.manifest.json'
+
+# lists of packages which are not in pacman sync databases
+NON_REPO_GROUPS = {'aur', 'flatpak'}
+
+
+def parse_list(file_name, files=None, parsed=None):
+    """get packages of list file, follow '@include other.txt' lines"""
+    # files is the include chain, parsed collect every file read
+    files = [] if files is None else files
+    file_name = os.path.abspath(file_name)
+    if file_name in files:
+        raise ValueError(f'{file_name} is included in itself')
+    files.append(file_name)
+    if parsed is not None:
+        parsed.add(file_name)
+
+    packages = []
+    with open(file_name) as reader:
+        for line_number, line in enumerate(reader, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            if line.startswith('@include '):
+                included = line[len('@include '):].strip()
+                packages += parse_list(
+                    os.path.join(os.path.dirname(file_name), included),
+                    files, parsed
+                )
+            elif len(line.split()) == 1:
+                packages.append(line)
+            else:
+                raise ValueError(
+                    f'{file_name}:{line_number}: one package per line'
+                )
+
+    files.pop()
+
+    return packages
+
+
+def get_mtimes(list_dir, included=()):
+    """get modification time of list files and files they include"""
+    return {
+        path: os.stat(path).st_mtime_ns
+        for path in sorted(
+            [os.path.abspath(path) for path in glob.glob(f'{list_dir}/*.txt')]
+            + list(included)
+        )
+    }
+
+
+def compile_manifest(list_dir):
+    """parse all list files of directory into groups of unique packages"""
+    groups = {}
+    owners = {}
+    parsed = set()
+
+    for file_name in sorted(glob.glob(f'{list_dir}/*.txt')):
+        group = os.path.basename(file_name)[:-len('.txt')]
+        packages = parse_list(file_name, parsed=parsed)
+        groups[group] = list(dict.fromkeys(packages))
+        for package in groups[group]:
+            owners.setdefault(package, []).append(group)
+
+    # included files may be outside of list directory
+    included = sorted(parsed - {
+        os.path.abspath(path) for path in glob.glob(f'{list_dir}/*.txt')
+    })
+
+    return {
+        'mtimes': get_mtimes(list_dir, included),
+        'included': included,
+        'groups': groups,
+        'duplicates': {
+            package: owner_groups
+            for package, owner_groups in owners.items()
+            if len(owner_groups) > 1
+        }
+    }
+
+
+def load_manifest(list_dir):
+    """get manifest of list directory, compile it only if lists changed"""
+    cache_path = os.path.join(list_dir, MANIFEST_CACHE)
+    manifest = fileutils.load_json(cache_path)
+
+    # added, removed and changed lists all change mtimes
+    try:
+        if manifest and manifest['mtimes'] == get_mtimes(
+            list_dir, manifest.get('included', [])
+        ):
+            return manifest
+    except FileNotFoundError:
+        # an included list is gone
+        pass
+
+    manifest = compile_manifest(list_dir)
+    for package, groups in manifest['duplicates'].items():
+        print(f'{package} is listed in more than one list: ' +
+              ', '.join(groups))
+
+    try:
+        fileutils.save_json(cache_path, manifest)
+    except OSError:
+        pass
+
+    return manifest
+
+
+def get_all_packages(manifest, groups=None):
+    """get unique packages of groups (all repository groups by default)"""
+    if groups is None:
+        groups = [
+            group for group in manifest['groups']
+            if group not in NON_REPO_GROUPS
+        ]
+
+    return list(dict.fromkeys(
+        package for group in groups
+        for package in manifest['groups'][group]
+    ))
+
+
+def get_known_packages(cmd_prefix=None):
+    """get names of packages and groups in pacman sync databases"""
+    cmd_prefix = cmd_prefix or []
+    known = set(subprocess.run(
+        cmd_prefix + ['pacman', '-Slq'],
+        capture_output=True, text=True, check=True
+    ).stdout.split())
+    known.update(subprocess.run(
+        cmd_prefix + ['pacman', '-Sgq'],
+        capture_output=True, text=True
+    ).stdout.split())
+
+    return known
+
+
+def find_unknown_packages(manifest, groups, known, cmd_prefix=None):
+    """get {group: packages} of names of groups not in known packages"""
+    cmd_prefix = cmd_prefix or []
+    groups = [group for group in groups if group not in NON_REPO_GROUPS]
+    missing = [
+        package for package in get_all_packages(manifest, groups)
+        if package not in known
+    ]
+
+    # names only provided by other packages (e.g. java-runtime) are fine,
+    # pacman resolve them all in one call
+    if missing:
+        output = subprocess.run(
+            cmd_prefix + ['pacman', '-Sp', '--print-format', '%n'] + missing,
+            capture_output=True, text=True
+        ).stderr
+        not_found = set(re.findall(r'target not found: (\S+)', output))
+        missing = [package for package in missing if package in not_found]
+
+    return {
+        group: [
+            package for package in manifest['groups'][group]
+            if package in missing
+        ]
+        for group in groups
+        if any(package in missing for package in manifest['groups'][group])
+    }
@@ -0,0 +1,470 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+import mmap
+import os
+import random
+import struct
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import fileutils
+
+QCOW2_MAGIC = b'QFI\xfb'
+HEADER_FORMAT = '>4sIQIIQIIQQIIQ'
+HEADER_V3_FORMAT = '>QQQII'
+SNAPSHOT_FORMAT = '>QIHHIIQII'
+HEADER_FIELDS = (
+    'magic', 'version', 'backing_file_offset', 'backing_file_size',
+    'cluster_bits', 'size', 'crypt_method', 'l1_size', 'l1_table_offset',
+    'refcount_table_offset', 'refcount_table_clusters', 'nb_snapshots',
+    'snapshots_offset'
+)
+HEADER_V3_FIELDS = (
+    'incompatible_features', 'compatible_features', 'autoclear_features',
+    'refcount_order', 'header_length'
+)
+
+# incompatible features which change how the image must be handled
+INCOMPATIBLE_DIRTY = 1 << 0
+INCOMPATIBLE_CORRUPT = 1 << 1
+INCOMPATIBLE_EXTERNAL_DATA = 1 << 2
+INCOMPATIBLE_EXTENDED_L2 = 1 << 4
+
+# L1 and L2 table entries
+OFFSET_MASK = 0x00fffffffffffe00
+ENTRY_COPIED = 1 << 63
+ENTRY_COMPRESSED = 1 << 62
+ENTRY_ZERO = 1
+
+# clusters read to estimate how much of the data is zeros
+SAMPLE_CLUSTERS = 256
+
+
+def read_header(fd):
+    """read qcow2 header as dict"""
+    data = os.pread(fd, 104, 0)
+    if data[:4] != QCOW2_MAGIC:
+        raise ValueError('not a qcow2 image')
+
+    header = dict(zip(
+        HEADER_FIELDS, struct.unpack_from(HEADER_FORMAT, data)
+    ))
+
+    # version 2 has fixed feature set and 16 bit refcounts
+    if header['version'] >= 3:
+        header.update(zip(
+            HEADER_V3_FIELDS,
+            struct.unpack_from(HEADER_V3_FORMAT, data, 72)
+        ))
+    else:
+        header.update(dict.fromkeys(HEADER_V3_FIELDS, 0))
+        header['refcount_order'] = 4
+
+    header['cluster_size'] = 1 << header['cluster_bits']
+    header['refcount_bits'] = 1 << header['refcount_order']
+
+    return header
+
+
+def check_supported(header):
+    """raise ValueError if image can not be edited in place"""
+    incompatible = header['incompatible_features']
+
+    if header['crypt_method']:
+        raise ValueError('encrypted images are not supported')
+    if incompatible & (INCOMPATIBLE_DIRTY | INCOMPATIBLE_CORRUPT):
+        raise ValueError('image needs repair (qemu-img check -r all)')
+    if incompatible & (INCOMPATIBLE_EXTERNAL_DATA | INCOMPATIBLE_EXTENDED_L2):
+        raise ValueError('external data file and extended L2 entries ' +
+                         'are not supported')
+    if header['refcount_bits'] < 8:
+        raise ValueError('refcounts narrower than 8 bits are not supported')
+
+
+def read_table(fd, offset, count):
+    """read table of big-endian 64 bit entries"""
+    return list(struct.unpack(f'>{count}Q', os.pread(fd, count * 8, offset)))
+
+
+class Refcounts:
+    """refcount blocks of image, loaded on demand and written back"""
+
+    def __init__(self, fd, header):
+        self.fd = fd
+        self.cluster_size = header['cluster_size']
+        self.entry_size = header['refcount_bits'] // 8
+        self.entries_per_block = self.cluster_size // self.entry_size
+        self.table = read_table(
+            fd, header['refcount_table_offset'],
+            header['refcount_table_clusters'] * self.cluster_size // 8
+        )
+        self.blocks = {}
+        self.dirty = set()
+
+    def get_block(self, block_index):
+        """get refcount block, None if it is not allocated"""
+        if block_index >= len(self.table):
+            return None
+
+        offset = self.table[block_index] & OFFSET_MASK
+        if not offset:
+            return None
+
+        if block_index not in self.blocks:
+            self.blocks[block_index] = bytearray(
+                os.pread(self.fd, self.cluster_size, offset)
+            )
+
+        return self.blocks[block_index]
+
+    def get(self, cluster_index):
+        """get refcount of host cluster"""
+        block_index, index = divmod(cluster_index, self.entries_per_block)
+        block = self.get_block(block_index)
+        if block is None:
+            return 0
+
+        start = index * self.entry_size
+        return int.from_bytes(block[start:start + self.entry_size], 'big')
+
+    def set(self, cluster_index, refcount):
+        """set refcount of host cluster (in memory until flush)"""
+        block_index, index = divmod(cluster_index, self.entries_per_block)
+        block = self.get_block(block_index)
+        start = index * self.entry_size
+        block[start:start + self.entry_size] = refcount.to_bytes(
+            self.entry_size, 'big'
+        )
+        self.dirty.add(block_index)
+
+    def flush(self):
+        """write changed refcount blocks back"""
+        for block_index in sorted(self.dirty):
+            os.pwrite(
+                self.fd, self.blocks[block_index],
+                self.table[block_index] & OFFSET_MASK
+            )
+        self.dirty.clear()
+        os.fsync(self.fd)
+
+
+def iter_data_clusters(fd, header, refcounts):
+    """iterate (host offset, l2 offset, l2 index) of unshared data clusters"""
+    cluster_size = header['cluster_size']
+    l2_size = cluster_size // 8
+
+    l1_table = read_table(fd, header['l1_table_offset'], header['l1_size'])
+    for l1_entry in l1_table:
+        l2_offset = l1_entry & OFFSET_MASK
+
+        # L2 table shared with an internal snapshot must stay as it is
+        if not l2_offset or refcounts.get(l2_offset // cluster_size) != 1:
+            continue
+
+        l2_table = read_table(fd, l2_offset, l2_size)
+        for l2_index, l2_entry in enumerate(l2_table):
+            if l2_entry & (ENTRY_COMPRESSED | ENTRY_ZERO):
+                continue
+
+            host_offset = l2_entry & OFFSET_MASK
+            if host_offset and \
+                    refcounts.get(host_offset // cluster_size) == 1:
+                yield host_offset, l2_offset, l2_index
+
+
+def find_zero_clusters(fd, header, refcounts, size):
+    """find unshared data clusters which contain only zeros"""
+    cluster_size = header['cluster_size']
+    zero_cluster = bytes(cluster_size)
+    clusters = sorted(iter_data_clusters(fd, header, refcounts))
+
+    if not clusters:
+        return []
+
+    # each allocated cluster is read once, in file order
+    with mmap.mmap(fd, size, prot=mmap.PROT_READ) as image:
+        image.madvise(mmap.MADV_SEQUENTIAL)
+        return [
+            cluster for cluster in clusters
+            if image[cluster[0]:cluster[0] + cluster_size] == zero_cluster
+        ]
+
+
+def find_free_clusters(fd, header, refcounts, size):
+    """find allocated host clusters which nothing refer to"""
+    cluster_size = header['cluster_size']
+    free_clusters = []
+
+    for start, end in fileutils.iter_data_segments(fd, size):
+        for cluster_index in range(start // cluster_size, end // cluster_size):
+            if refcounts.get(cluster_index) == 0:
+                free_clusters.append(cluster_index * cluster_size)
+
+    return free_clusters
+
+
+def merge_ranges(offsets, length):
+    """merge offsets of equal length ranges into (start, length) runs"""
+    runs = []
+    for offset in sorted(offsets):
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1][1] += length
+        else:
+            runs.append([offset, length])
+
+    return runs
+
+
+def sparsify(path_to_image):
+    """zero out zero clusters and punch holes for them and free clusters"""
+    with open(path_to_image, 'r+b') as image:
+        fd = image.fileno()
+        size = os.fstat(fd).st_size
+        header = read_header(fd)
+        check_supported(header)
+        cluster_size = header['cluster_size']
+        refcounts = Refcounts(fd, header)
+
+        # unallocated cluster of version 2 image read from backing file
+        if header['version'] >= 3:
+            zero_entry = ENTRY_ZERO
+        elif not header['backing_file_offset']:
+            zero_entry = 0
+        else:
+            zero_entry = None
+
+        zero_clusters = []
+        if zero_entry is not None:
+            zero_clusters = find_zero_clusters(fd, header, refcounts, size)
+        free_clusters = find_free_clusters(fd, header, refcounts, size)
+
+        # L2 entries first, a crash after it only leak clusters
+        l2_entries = {}
+        for host_offset, l2_offset, l2_index in zero_clusters:
+            l2_entries[l2_offset + l2_index * 8] = zero_entry
+        for offset, entry in sorted(l2_entries.items()):
+            os.pwrite(fd, struct.pack('>Q', entry), offset)
+        os.fsync(fd)
+
+        for host_offset, _, _ in zero_clusters:
+            refcounts.set(host_offset // cluster_size, 0)
+        refcounts.flush()
+
+        holes = merge_ranges(
+            [cluster[0] for cluster in zero_clusters] + free_clusters,
+            cluster_size
+        )
+        for offset, length in holes:
+            fileutils.punch_hole(fd, offset, length)
+
+    return {
+        'zero': len(zero_clusters),
+        'free': len(free_clusters),
+        'reclaimed': (len(zero_clusters) + len(free_clusters)) * cluster_size
+    }
+
+
+def scan_image(path_to_image, sample_count=SAMPLE_CLUSTERS):
+    """estimate reclaimable space of image from metadata and a few samples"""
+    with open(path_to_image, 'rb') as image:
+        fd = image.fileno()
+        header = read_header(fd)
+
+        # e.g. refcounts of an encrypted or dirty image can not be trusted
+        try:
+            check_supported(header)
+        except ValueError as error:
+            return {'path': path_to_image, 'skipped': str(error)}
+
+        cluster_size = header['cluster_size']
+        refcounts = Refcounts(fd, header)
+
+        stat = os.fstat(fd)
+        allocated = stat.st_blocks * 512
+        free = len(
+            find_free_clusters(fd, header, refcounts, stat.st_size)
+        ) * cluster_size
+
+        # host clusters of guest data in guest order, count discontinuity
+        data_count = breaks = 0
+        previous = None
+        unshared = []
+        l1_table = read_table(fd, header['l1_table_offset'], header['l1_size'])
+        for l1_entry in l1_table:
+            l2_offset = l1_entry & OFFSET_MASK
+            if not l2_offset:
+                continue
+
+            for l2_entry in read_table(fd, l2_offset, cluster_size // 8):
+                host_offset = l2_entry & OFFSET_MASK
+                if not host_offset or \
+                        l2_entry & (ENTRY_COMPRESSED | ENTRY_ZERO):
+                    continue
+
+                data_count += 1
+                if previous is not None and \
+                        host_offset != previous + cluster_size:
+                    breaks += 1
+                previous = host_offset
+
+                # copied flag means refcount is exactly one
+                if l1_entry & ENTRY_COPIED and l2_entry & ENTRY_COPIED:
+                    unshared.append(host_offset)
+
+        # zero clusters of version 2 image with backing file can not be freed
+        zero = 0
+        if unshared and (
+            header['version'] >= 3 or not header['backing_file_offset']
+        ):
+            zero_cluster = bytes(cluster_size)
+            samples = random.sample(unshared, min(sample_count, len(unshared)))
+            zero_samples = sum(
+                os.pread(fd, cluster_size, offset) == zero_cluster
+                for offset in samples
+            )
+            zero = zero_samples * len(unshared) // len(samples) * cluster_size
+
+    return {
+        'path': path_to_image,
+        'size': header['size'],
+        'allocated': allocated,
+        'reclaimable': free + zero,
+        'fragmentation': breaks / (data_count - 1) if data_count > 1 else 0.0
+    }
+
+
+def scan_images(paths):
+    """scan images concurrently, reports are in the order of paths"""
+    def scan(path):
+        try:
+            return scan_image(path)
+        except (OSError, ValueError) as error:
+            return {'path': path, 'error': str(error)}
+
+    if not paths:
+        return []
+
+    with ThreadPoolExecutor(min(len(paths), os.cpu_count() * 2)) as executor:
+        return list(executor.map(scan, paths))
+
+
+def read_snapshot_l1_tables(fd, header):
+    """get (offset, size) of L1 tables of internal snapshots"""
+    tables = []
+    offset = header['snapshots_offset']
+    snapshot_size = struct.calcsize(SNAPSHOT_FORMAT)
+
+    for _ in range(header['nb_snapshots']):
+        l1_offset, l1_size, id_size, name_size, *_, extra_size = \
+            struct.unpack(SNAPSHOT_FORMAT, os.pread(fd, snapshot_size, offset))
+        tables.append((l1_offset, l1_size))
+
+        # entries are padded to 8 bytes
+        offset += snapshot_size + extra_size + id_size + name_size
+        offset = (offset + 7) & ~7
+
+    return tables, offset
+
+
+def get_compressed_range(l2_entry, cluster_bits):
+    """get host (offset, length) of compressed cluster"""
+    offset_bits = 62 - (cluster_bits - 8)
+    offset = l2_entry & ((1 << offset_bits) - 1)
+    sectors = ((l2_entry >> offset_bits) & ((1 << (cluster_bits - 8)) - 1)) + 1
+
+    return offset, (offset & ~511) + sectors * 512 - offset
+
+
+def check_image(path_to_image):
+    """check header and refcounts of image like qemu-img check"""
+    errors = []
+    referenced = Counter()
+
+    with open(path_to_image, 'rb') as image:
+        fd = image.fileno()
+        size = os.fstat(fd).st_size
+        header = read_header(fd)
+        cluster_size = header['cluster_size']
+        refcounts = Refcounts(fd, header)
+
+        if header['version'] not in (2, 3):
+            raise ValueError(f'unknown qcow2 version {header["version"]}')
+
+        def reference(offset, length, what):
+            if offset + length > size:
+                errors.append(f'{what} at {offset} is past end of file')
+                return
+
+            first = offset // cluster_size
+            last = (offset + length - 1) // cluster_size
+            for cluster_index in range(first, last + 1):
+                referenced[cluster_index] += 1
+
+        reference(0, cluster_size, 'header')
+        reference(
+            header['refcount_table_offset'],
+            header['refcount_table_clusters'] * cluster_size,
+            'refcount table'
+        )
+        for entry in refcounts.table:
+            if entry & OFFSET_MASK:
+                reference(entry & OFFSET_MASK, cluster_size, 'refcount block')
+
+        snapshot_tables, snapshots_end = read_snapshot_l1_tables(fd, header)
+        if snapshot_tables:
+            reference(
+                header['snapshots_offset'],
+                snapshots_end - header['snapshots_offset'],
+                'snapshot table'
+            )
+
+        # data clusters are counted once per L1 table using the L2 table
+        l2_references = {}
+        l1_tables = [(header['l1_table_offset'], header['l1_size'])]
+        for l1_offset, l1_size in l1_tables + snapshot_tables:
+            if l1_size:
+                reference(l1_offset, l1_size * 8, 'L1 table')
+
+            for l1_entry in read_table(fd, l1_offset, l1_size):
+                l2_offset = l1_entry & OFFSET_MASK
+                if not l2_offset:
+                    continue
+
+                reference(l2_offset, cluster_size, 'L2 table')
+                if l2_offset not in l2_references:
+                    l2_references[l2_offset] = []
+                    for l2_entry in read_table(
+                        fd, l2_offset, cluster_size // 8
+                    ):
+                        if l2_entry & ENTRY_COMPRESSED:
+                            l2_references[l2_offset].append(
+                                get_compressed_range(
+                                    l2_entry, header['cluster_bits']
+                                )
+                            )
+                        elif l2_entry & OFFSET_MASK:
+                            l2_references[l2_offset].append(
+                                (l2_entry & OFFSET_MASK, cluster_size)
+                            )
+
+                for offset, length in l2_references[l2_offset]:
+                    reference(offset, length, 'data cluster')
+
+        # referenced more than refcount is corruption, less is only a leak
+        leaks = 0
+        cluster_count = max(
+            (size + cluster_size - 1) // cluster_size,
+            max(referenced, default=-1) + 1
+        )
+        for cluster_index in range(cluster_count):
+            refcount = refcounts.get(cluster_index)
+            if refcount < referenced[cluster_index]:
+                errors.append(
+                    f'cluster {cluster_index} refcount={refcount} reference=' +
+                    f'{referenced[cluster_index]}'
+                )
+            elif refcount > referenced[cluster_index]:
+                leaks += 1
+
+    return {'errors': errors, 'leaks': leaks}
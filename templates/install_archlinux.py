@@ -16,11 +16,17 @@ from lib.archinstall import ArchInstall
 
 arch_install = ArchInstall('settings.json')
 
-arch_install.execute_method(arch_install.install_base_system)
-arch_install.execute_method(arch_install.configure_as_virtualbox_guest)
-arch_install.execute_method(arch_install.install_pipewire)
-arch_install.execute_method(arch_install.install_gnome_de)
-arch_install.execute_method(arch_install.configure_display_manager, 'gdm')
-arch_install.execute_method(arch_install.install_fonts)
-arch_install.execute_method(arch_install.install_browsers)
-arch_install.execute_method(arch_install.install_editors)
+try:
+    arch_install.execute_method(arch_install.install_base_system)
+    arch_install.execute_method(arch_install.configure_as_virtualbox_guest)
+    arch_install.execute_method(arch_install.install_pipewire)
+    arch_install.execute_method(arch_install.install_gnome_de)
+    arch_install.execute_method(arch_install.configure_display_manager, 'gdm')
+    arch_install.execute_method(arch_install.install_fonts)
+    arch_install.execute_method(arch_install.install_browsers)
+    arch_install.execute_method(arch_install.install_editors)
+finally:
+    # units and group memberships requested by the steps above are applied
+    # in one go, even if a step failed
+    arch_install.execute_method(arch_install.enable_pending_units)
+    arch_install.execute_method(arch_install.apply_pending_memberships)
@@ -1,66 +1,255 @@
 # author: Le Anh Tai
 # email: leanhtai01@gmail.com
 # GitHub: https://github.com/leanhtai01
-import subprocess
+if __package__ is None:
+    import os
+    import sys
 
+    sys.path.append(
+        os.path.dirname(
+            os.path.dirname(
+                os.path.abspath(__file__)
+            )
+        )
+    )
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
 
-def main():
-    subprocess.run(['sudo', 'virsh', 'list', '--all'])
-    vm_name = input('Enter KVM virtual machine name: ')
-    backup_location = subprocess.check_output(
-        'read -e -p "Enter backup location: " path; echo $path',
-        shell=True
-    ).decode().strip() + vm_name
+from lib import backuputils, fileutils, kvmutils
 
-    # make directory for VM
-    subprocess.run(['mkdir', f'{backup_location}'])
 
-    # copy disk file
-    subprocess.run([
-        'sudo', 'cp',
-        f'/var/lib/libvirt/images/{vm_name}.qcow2',
-        f'{backup_location}'
+def dump_vm_metadata(vm_name, backup_location):
+    """dump VM's XML and its snapshots' XML"""
+    vm_xml, snapshot_list = kvmutils.run_virsh([
+        ['dumpxml', vm_name],
+        ['snapshot-list', '--name', '--topological', vm_name]
     ])
+    with open(f'{backup_location}/{vm_name}.xml', 'w') as writer:
+        writer.write(vm_xml)
 
-    # dump vm's xml
-    subprocess.run(
-        f'sudo virsh dumpxml {vm_name} > ' +
-        f'{backup_location}/{vm_name}.xml',
-        shell=True
+    # dump snapshots
+    os.makedirs(f'{backup_location}/snapshots', exist_ok=True)
+    snapshots = [name for name in snapshot_list.splitlines() if name]
+    snapshot_xmls = kvmutils.dump_snapshot_xmls(vm_name, snapshots)
+
+    for snapshot in snapshots:
+        path = f'{backup_location}/snapshots/{snapshot}.xml'
+        with open(path, 'w') as writer:
+            writer.write(snapshot_xmls[snapshot])
+
+    # parents come before their children
+    with open(f'{backup_location}/snapshots_structure', 'w') as writer:
+        writer.writelines(f'{snapshot}.xml\n' for snapshot in snapshots)
+
+
+def backup_incremental(vm_name, vm_backup_dir, chunks_dir, throttle=None):
+    """store only chunks not yet in the store shared by all VMs"""
+    point_dir = f'{vm_backup_dir}/{datetime.now().strftime("%Y%m%d_%H%M%S")}'
+    os.makedirs(point_dir)
+
+    manifest, stats = backuputils.backup_image(
+        f'{kvmutils.IMAGES_DIR}/{vm_name}.qcow2', chunks_dir, throttle
     )
+    manifest['chunks_dir'] = os.path.relpath(chunks_dir, point_dir)
+    fileutils.save_json(f'{point_dir}/manifest.json', manifest)
 
-    # dump snapshots
-    subprocess.run(
-        f'mkdir {backup_location}/snapshots',
-        shell=True
+    # only chunks this backup wrote, other backups may be writing to the
+    # shared store at the same time
+    username = kvmutils.get_normal_user()
+    paths = set(stats['paths'])
+    if paths:
+        paths |= {chunks_dir} | {os.path.dirname(path) for path in paths}
+    for path in sorted(paths):
+        shutil.chown(path, username, username)
+
+    print(
+        f'Stored {stats["new"] / 1024 ** 3:.2f} GiB of new chunks ' +
+        f'({stats["written"] / 1024 ** 3:.2f} GiB compressed) ' +
+        f'of {stats["size"] / 1024 ** 3:.2f} GiB {vm_name} image'
     )
 
-    snapshots = subprocess.check_output(
-        f'sudo virsh snapshot-list --name --topological {vm_name}', shell=True
-    ).decode().strip().splitlines()
+    return point_dir
 
-    for snapshot in snapshots:
-        subprocess.run(
-            f'echo "{snapshot}.xml" >> ' +
-            f'{backup_location}/snapshots_structure',
-            shell=True
+
+def backup_disk(vm_name, backup_location, chunks_dir, is_incremental,
+                throttle=None):
+    """back up VM's disk, return directory to dump metadata to"""
+    if is_incremental:
+        return backup_incremental(
+            vm_name, backup_location, chunks_dir, throttle
         )
 
-        subprocess.run(
-            f'sudo virsh snapshot-dumpxml {vm_name} {snapshot} > ' +
-            f'{backup_location}/snapshots/{snapshot}.xml',
-            shell=True
+    # make directory for VM
+    os.makedirs(backup_location, exist_ok=True)
+
+    # copy disk file
+    path_to_copy = f'{backup_location}/{vm_name}.qcow2'
+    stats = fileutils.copy_file(
+        f'{kvmutils.IMAGES_DIR}/{vm_name}.qcow2', path_to_copy, throttle,
+        fileutils.HASH_CHUNK_SIZE
+    )
+    kvmutils.print_copy_stats(stats)
+
+    # digests of copied data, for verify_kvm_backup.py (a reflink copy has
+    # none, it only get structure checks)
+    digests_path = f'{path_to_copy}.digests.json'
+    if 'digests' in stats:
+        fileutils.save_json(digests_path, {
+            'chunk_size': fileutils.HASH_CHUNK_SIZE,
+            'digests': stats['digests']
+        })
+    elif os.path.exists(digests_path):
+        os.remove(digests_path)
+
+    return backup_location
+
+
+def backup_vm(vm_name, backup_root, is_incremental, throttle=None):
+    """back up VM's disk and metadata, return timing of the backup"""
+    backup_location = backup_root + vm_name
+    chunks_dir = backup_root + '.chunk_store'
+    path_to_image = f'{kvmutils.IMAGES_DIR}/{vm_name}.qcow2'
+    start = time.monotonic()
+    redirected = 0.0
+
+    if kvmutils.get_vm_state(vm_name) == 'running':
+        # back up running VM from its quiescent image, without downtime
+        with kvmutils.redirect_disk_writes(vm_name, path_to_image) as redirect:
+            metadata_dir = backup_disk(
+                vm_name, backup_location, chunks_dir, is_incremental, throttle
+            )
+        redirected = redirect['seconds']
+        print(f'{vm_name}: guest I/O was redirected for {redirected:.1f}s')
+    else:
+        metadata_dir = backup_disk(
+            vm_name, backup_location, chunks_dir, is_incremental, throttle
         )
 
+    dump_vm_metadata(vm_name, metadata_dir)
+
     # change directory permission
-    username = subprocess.check_output('whoami', shell=True).decode().strip()
-    subprocess.run(
-        f'sudo chown -R {username}:{username} {backup_location}',
-        shell=True
+    username = kvmutils.get_normal_user()
+    kvmutils.chown_tree(backup_location, username)
+    if not is_incremental:
+        os.chmod(f'{backup_location}/{vm_name}.qcow2', 0o666)
+
+    return {
+        'vm': vm_name,
+        'size': os.path.getsize(path_to_image),
+        'seconds': time.monotonic() - start,
+        'redirected': redirected
+    }
+
+
+def print_backup_summary(results):
+    """print per VM timing and throughput table"""
+    print(
+        f'{"VM":<24}{"GiB":>8}{"Seconds":>10}{"MiB/s":>10}' +
+        f'{"Redirect":>10}  Status'
+    )
+
+    for task, result in results:
+        if isinstance(result, Exception):
+            print(
+                f'{task["vm"]:<24}{task["size"] / 1024 ** 3:>8.2f}' +
+                f'{"":>30}  failed: {result}'
+            )
+            continue
+
+        seconds = result['seconds']
+        throughput = result['size'] / 1024 ** 2 / seconds if seconds else 0
+        print(
+            f'{result["vm"]:<24}{result["size"] / 1024 ** 3:>8.2f}' +
+            f'{seconds:>10.1f}{throughput:>10.1f}' +
+            f'{result["redirected"]:>10.1f}  done'
+        )
+
+
+def backup_all_vms(backup_root, is_incremental, bandwidth, queue_depth):
+    """back up every VM concurrently, bounded by bandwidth and queue depth"""
+    vm_names = kvmutils.run_virsh([['list', '--all', '--name']])[0].split()
+    backup_device = os.stat(backup_root).st_dev
+
+    tasks = []
+    for vm_name in vm_names:
+        path_to_image = f'{kvmutils.IMAGES_DIR}/{vm_name}.qcow2'
+        if not os.path.exists(path_to_image):
+            print(f'Skip {vm_name}: {path_to_image} not found')
+            continue
+
+        tasks.append({
+            'vm': vm_name,
+            'size': os.path.getsize(path_to_image),
+            'devices': {os.stat(path_to_image).st_dev, backup_device}
+        })
+
+    # bandwidth is in MiB/s, shared by all running backups
+    throttle = None
+    if bandwidth:
+        throttle = fileutils.Throttle(bandwidth * 1024 ** 2)
+
+    results = kvmutils.run_largest_first(
+        tasks, queue_depth,
+        lambda task: backup_vm(
+            task['vm'], backup_root, is_incremental, throttle
+        )
     )
-    subprocess.run(
-        f'chmod 666 {backup_location}/{vm_name}.qcow2', shell=True
+    print_backup_summary(results)
+
+    return all(not isinstance(result, Exception) for _, result in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='back up KVM virtual machine (prompt if no --all)'
     )
+    parser.add_argument(
+        '--all', action='store_true',
+        help='back up all VMs to --location without prompting'
+    )
+    parser.add_argument('--location', help='backup location')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument(
+        '--bandwidth', type=float, default=0,
+        help='aggregate read bandwidth in MiB/s (default: unlimited)'
+    )
+    parser.add_argument(
+        '--queue-depth', type=int, default=2,
+        help='number of backups at once per device (default: 2)'
+    )
+    args = parser.parse_args()
+
+    if args.queue_depth < 1:
+        parser.error('--queue-depth must be at least 1')
+
+    # disk images are only readable by root
+    kvmutils.run_as_root()
+
+    if args.all:
+        if not args.location:
+            parser.error('--all requires --location')
+
+        backup_root = os.path.join(args.location, '')
+        if not backup_all_vms(
+            backup_root, args.incremental, args.bandwidth, args.queue_depth
+        ):
+            sys.exit(1)
+        return
+
+    subprocess.run([kvmutils.VIRSH, 'list', '--all'])
+    vm_name = input('Enter KVM virtual machine name: ')
+    backup_root = subprocess.check_output(
+        'read -e -p "Enter backup location: " path; echo $path',
+        shell=True
+    ).decode().strip()
+    is_incremental = input('Incremental backup? (y/n): ').lower() == 'y'
+
+    backup_vm(vm_name, backup_root, is_incremental)
 
     print('Backup complete!')
 
@@ -13,23 +13,26 @@ if __package__ is None:
         )
     )
 import subprocess
+import sys
 
+from lib import isoutils
 
-def main():
-    path_to_iso = subprocess.check_output(
-        'read -e -p "Enter path to the iso: " path; echo $path',
-        shell=True
-    ).decode().strip()
+BOOT_FILES = ['/boot/etfsboot.com', '/efi/microsoft/boot/efisys.bin']
+
+# let user choose version of Windows on install
+EI_CFG = b'[Channel]\r\nRetail\r\n'
 
-    # get the iso information
-    file_name = os.path.splitext(path_to_iso)[0] + '_modified.iso'
-    volume_name = subprocess.check_output(
-        f'iso-info {path_to_iso} | ' +
-        "grep -i '^Volume[ ]*:' | " +
-        "cut -d':' -f2 | " +
-        "sed 's/^ //g'",
-        shell=True
-    ).decode().strip()
+
+def remaster_iso(path_to_iso, file_name, iso_info):
+    """make custom iso from a mounted copy of the iso (slow)"""
+    volume_name = iso_info['volume_id']
+
+    # make sure boot images used by mkisofs below are there
+    paths = {file['path'].lower() for file in iso_info['files']}
+    missing_boot_files = [path for path in BOOT_FILES if path not in paths]
+    if missing_boot_files:
+        print(f'Missing boot files: {", ".join(missing_boot_files)}')
+        sys.exit(1)
 
     # mount the iso
     subprocess.run([
@@ -41,9 +44,8 @@ def main():
         'mkdir', '-p', '/tmp/modified/sources'
     ])
 
-    # let user choose version of Windows on install
-    with open('/tmp/modified/sources/ei.cfg', 'w') as writer:
-        writer.write('[Channel]\r\nRetail\r\n')
+    with open('/tmp/modified/sources/ei.cfg', 'wb') as writer:
+        writer.write(EI_CFG)
 
     # create custom iso (need cdrtools)
     subprocess.run(
@@ -72,6 +74,30 @@ def main():
         'sudo', 'umount', '/mnt'
     ])
 
+
+def main():
+    path_to_iso = subprocess.check_output(
+        'read -e -p "Enter path to the iso: " path; echo $path',
+        shell=True
+    ).decode().strip()
+
+    # get the iso information
+    file_name = os.path.splitext(path_to_iso)[0] + '_modified.iso'
+    iso_info = isoutils.inspect_iso(path_to_iso)
+
+    for entry in iso_info['boot_entries']:
+        print(
+            f'Boot entry: {entry["platform"]}, ' +
+            f'{entry["sector_count"]} sectors at {entry["load_rba"]}'
+        )
+
+    # Windows ISO keep its files in UDF, so ei.cfg is patched in without
+    # mounting or copying the whole tree
+    if iso_info['is_udf']:
+        isoutils.patch_iso(path_to_iso, file_name, {'/sources/ei.cfg': EI_CFG})
+    else:
+        remaster_iso(path_to_iso, file_name, iso_info)
+
     print('Successfully making custom Windows iso!\n')
 
 
@@ -12,23 +12,87 @@ if __package__ is None:
             )
         )
     )
+import argparse
+import os
 import subprocess
+import sys
 
-from lib import ioutils
+from lib import fileutils, ioutils, isoutils
+
+
+def build_iso(path_to_dir, path_to_iso, volume_name):
+    """build ISO from directory, skip or patch it if possible"""
+    manifest_path = path_to_iso + '.manifest.json'
+    manifest = fileutils.load_json(manifest_path)
+    if not os.path.exists(path_to_iso) or not manifest or \
+            manifest['volume_name'] != volume_name:
+        manifest = {'volume_name': volume_name, 'files': {}}
+
+    old_files = manifest['files']
+    files = fileutils.build_manifest(path_to_dir, old_files)
+
+    if files == old_files:
+        print(f'{path_to_iso} is up to date!')
+        return
+
+    # same tree with only changed contents or times, overwrite them in
+    # place (a touched file get its recorded date updated)
+    changed_files = {
+        f'/{path}': os.path.join(path_to_dir, path)
+        for path, info in files.items()
+        if info != old_files.get(path)
+    }
+    if not (files.keys() == old_files.keys() and
+            isoutils.update_iso9660_files(path_to_iso, changed_files)):
+        try:
+            subprocess.run([
+                'mkisofs', '-JR', '-V',
+                f'{volume_name}',
+                '-o', f'{path_to_iso}',
+                f'{path_to_dir}'
+            ], check=True)
+        except subprocess.CalledProcessError as error:
+            print(f'mkisofs failed with exit code {error.returncode}!')
+            sys.exit(1)
+        print(f'Rebuilt {path_to_iso}')
+    else:
+        print(f'Updated {len(changed_files)} file(s) in {path_to_iso}')
+
+    manifest['files'] = files
+    fileutils.save_json(manifest_path, manifest)
 
 
 def main():
-    path_to_dir = ioutils.inputPath('Enter path to directory: ')
-    save_location = ioutils.inputPath('Enter location to save ISO: ')
-    volume_name = input('Enter volume name: ')
-    file_name = input('Enter the new file name of ISO: ')
-
-    subprocess.run([
-        'mkisofs', '-JR', '-V',
-        f'{volume_name}',
-        '-o', f'{save_location}{file_name}',
-        f'{path_to_dir}'
-    ])
+    parser = argparse.ArgumentParser(
+        description='make ISO from directory (prompt for missing options)'
+    )
+    parser.add_argument('--dir', dest='path_to_dir')
+    parser.add_argument('--output', dest='path_to_iso')
+    parser.add_argument('--volume-name')
+    args = parser.parse_args()
+
+    if args.path_to_dir:
+        path_to_dir = args.path_to_dir
+    else:
+        path_to_dir = ioutils.inputPath('Enter path to directory: ')
+
+    if not args.path_to_iso:
+        save_location = ioutils.inputPath('Enter location to save ISO: ')
+
+    volume_name = args.volume_name or input('Enter volume name: ')
+
+    if args.path_to_iso:
+        path_to_iso = args.path_to_iso
+    else:
+        file_name = input('Enter the new file name of ISO: ')
+        path_to_iso = f'{save_location}{file_name}'
+
+    build_iso(path_to_dir, path_to_iso, volume_name)
+
+    # quick check of the result without mounting it
+    iso_info = isoutils.inspect_iso(path_to_iso)
+    file_count = sum(not file['is_dir'] for file in iso_info['files'])
+    print(f'Volume {iso_info["volume_id"]} with {file_count} files ready!')
 
 
 if __name__ == '__main__':
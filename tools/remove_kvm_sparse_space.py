@@ -1,30 +1,126 @@
 # author: Le Anh Tai
 # email: leanhtai01@gmail.com
 # GitHub: https://github.com/leanhtai01
+if __package__ is None:
+    import os
+    import sys
+
+    sys.path.append(
+        os.path.dirname(
+            os.path.dirname(
+                os.path.abspath(__file__)
+            )
+        )
+    )
+import argparse
+import glob
+import os
 import subprocess
+import sys
 
+from lib import kvmutils, qcow2utils
 
-def main():
-    subprocess.run(['sudo', 'virsh', 'list', '--all'])
-    vm_name = input('Enter KVM virtual machine name: ')
 
-    subprocess.run(
-        'sudo qemu-img convert -O qcow2 ' +
-        f'/var/lib/libvirt/images/{vm_name}.qcow2 ' +
-        f'/var/lib/libvirt/images/{vm_name}.qcow2.new',
-        shell=True
-    )
+def convert_image(path_to_image):
+    """rewrite image into a new copy (need space for a second copy)"""
+    subprocess.run([
+        'qemu-img', 'convert', '-O', 'qcow2',
+        path_to_image, f'{path_to_image}.new'
+    ], check=True)
+    os.replace(f'{path_to_image}.new', path_to_image)
+
+
+def sparsify_image(path_to_image):
+    """sparsify image in place, convert it if that is not possible"""
+    try:
+        stats = qcow2utils.sparsify(path_to_image)
+        print(
+            f'Reclaimed {stats["reclaimed"] / 1024 ** 3:.2f} GiB ' +
+            f'({stats["zero"]} zero and {stats["free"]} free clusters)'
+        )
+    except ValueError as error:
+        print(f'Can not sparsify in place ({error}), converting instead')
+        convert_image(path_to_image)
 
-    subprocess.run(
-        f'sudo rm /var/lib/libvirt/images/{vm_name}.qcow2',
-        shell=True
+
+def print_report(reports):
+    """print per image size, allocation and reclaimable space table"""
+    print(
+        f'{"Image":<32}{"Size GiB":>10}{"Alloc GiB":>10}' +
+        f'{"Reclaim":>10}{"Frag %":>8}'
     )
 
-    subprocess.run(
-        f'sudo mv /var/lib/libvirt/images/{vm_name}.qcow2.new ' +
-        f'/var/lib/libvirt/images/{vm_name}.qcow2',
-        shell=True
+    for report in reports:
+        name = os.path.basename(report['path'])
+        if 'error' in report:
+            print(f'{name:<32}  {report["error"]}')
+            continue
+        if 'skipped' in report:
+            print(f'{name:<32}  skipped: {report["skipped"]}')
+            continue
+
+        print(
+            f'{name:<32}{report["size"] / 1024 ** 3:>10.2f}' +
+            f'{report["allocated"] / 1024 ** 3:>10.2f}' +
+            f'{report["reclaimable"] / 1024 ** 3:>10.2f}' +
+            f'{report["fragmentation"] * 100:>8.1f}'
+        )
+
+
+def sparsify_from_report(reports, min_reclaimable):
+    """sparsify shut off VMs whose estimated reclaimable space is enough"""
+    for report in reports:
+        if report.get('reclaimable', 0) < min_reclaimable:
+            continue
+
+        vm_name = os.path.basename(report['path'])[:-len('.qcow2')]
+        try:
+            state = kvmutils.get_vm_state(vm_name)
+        except RuntimeError:
+            state = 'unknown'
+        if state != 'shut off':
+            print(f'Skip {vm_name}: VM is {state}')
+            continue
+
+        print(f'Sparsifying {vm_name}...')
+        sparsify_image(report['path'])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='remove sparse space of KVM virtual machine image'
     )
+    parser.add_argument(
+        '--report', action='store_true',
+        help='only print reclaimable space of all images'
+    )
+    parser.add_argument(
+        '--min-reclaimable', type=float, metavar='GIB',
+        help='sparsify every shut off VM with at least GIB reclaimable'
+    )
+    args = parser.parse_args()
+
+    # only root can write to images directory
+    kvmutils.run_as_root()
+
+    if args.report or args.min_reclaimable is not None:
+        reports = qcow2utils.scan_images(
+            sorted(glob.glob(f'{kvmutils.IMAGES_DIR}/*.qcow2'))
+        )
+        print_report(reports)
+
+        if args.min_reclaimable is not None:
+            sparsify_from_report(reports, args.min_reclaimable * 1024 ** 3)
+        return
+
+    subprocess.run([kvmutils.VIRSH, 'list', '--all'])
+    vm_name = input('Enter KVM virtual machine name: ')
+
+    if kvmutils.get_vm_state(vm_name) != 'shut off':
+        print(f'{vm_name} must be shut off!')
+        sys.exit(1)
+
+    sparsify_image(f'{kvmutils.IMAGES_DIR}/{vm_name}.qcow2')
 
     print('Sparse space removed successfully!')
 
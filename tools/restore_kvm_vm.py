@@ -1,10 +1,69 @@
 # author: Le Anh Tai
 # email: leanhtai01@gmail.com
 # GitHub: https://github.com/leanhtai01
+if __package__ is None:
+    import os
+    import sys
+
+    sys.path.append(
+        os.path.dirname(
+            os.path.dirname(
+                os.path.abspath(__file__)
+            )
+        )
+    )
+import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import backuputils, fileutils, kvmutils
+
+
+def redefine_vm(vm_name, backup_location):
+    """define VM's XML and re-define snapshots (parents first)"""
+    with open(f'{backup_location}/snapshots_structure') as reader:
+        snapshot_xmls = reader.read().splitlines()
+
+    kvmutils.run_virsh(
+        [['define', f'{backup_location}/{vm_name}.xml']] + [
+            [
+                'snapshot-create', '--redefine', vm_name,
+                f'{backup_location}/snapshots/{snapshot_xml}'
+            ]
+            for snapshot_xml in snapshot_xmls
+        ]
+    )
+
+
+def restore_disk(vm_name, backup_location, manifest, is_preallocate):
+    """stream VM's disk into images directory"""
+    path_to_image = f'{kvmutils.IMAGES_DIR}/{vm_name}.qcow2'
+
+    if manifest:
+        # incremental backup, reassemble point in time from chunks
+        backuputils.restore_image(
+            manifest,
+            backuputils.get_chunks_dir(backup_location, manifest),
+            path_to_image
+        )
+        if is_preallocate:
+            kvmutils.convert_to_preallocated(path_to_image, path_to_image)
+    elif is_preallocate:
+        kvmutils.convert_to_preallocated(
+            f'{backup_location}/{vm_name}.qcow2', path_to_image
+        )
+    else:
+        # copy disk file
+        stats = fileutils.copy_file(
+            f'{backup_location}/{vm_name}.qcow2', path_to_image
+        )
+        kvmutils.print_copy_stats(stats)
 
 
 def main():
+    # only root can write to images directory
+    kvmutils.run_as_root()
+
     backup_location = subprocess.check_output(
         'read -e -p "Enter backup location: " path; echo $path',
         shell=True
@@ -13,29 +72,28 @@ def main():
     vm_name = input('Enter KVM virtual machine name: ')
     backup_location += vm_name
 
-    # copy disk file
-    subprocess.run(
-        f'sudo cp {backup_location}/{vm_name}.qcow2 ' +
-        '/var/lib/libvirt/images/',
-        shell=True
-    )
-
-    # define VM's XML
-    subprocess.run(
-        f'sudo virsh define {backup_location}/{vm_name}.xml',
-        shell=True
-    )
+    manifest = None
+    backup_points = backuputils.get_backup_points(backup_location)
+    if backup_points:
+        print('\n'.join(backup_points))
+        backup_point = input(
+            f'Enter backup point (default {backup_points[-1]}): '
+        ) or backup_points[-1]
+        backup_location += f'/{backup_point}'
+        manifest = fileutils.load_json(f'{backup_location}/manifest.json')
 
-    # re-define snapshots
-    with open(f'{backup_location}/snapshots_structure') as reader:
-        snapshot_xmls = reader.read().splitlines()
+    # converting drops internal snapshots, only offer it when there is none
+    is_preallocate = False
+    if os.path.getsize(f'{backup_location}/snapshots_structure') == 0:
+        is_preallocate = input(
+            'Preallocate metadata for faster guest writes? (y/n): '
+        ).lower() == 'y'
 
-    for snapshot_xml in snapshot_xmls:
-        subprocess.run(
-            f'sudo virsh snapshot-create --redefine ' +
-            f'{vm_name} {backup_location}/snapshots/{snapshot_xml}',
-            shell=True
-        )
+    # libvirt only record metadata, no need to wait for the disk
+    with ThreadPoolExecutor(1) as executor:
+        redefined = executor.submit(redefine_vm, vm_name, backup_location)
+        restore_disk(vm_name, backup_location, manifest, is_preallocate)
+        redefined.result()
 
     print('Restore complete!')
 
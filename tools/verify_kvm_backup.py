@@ -0,0 +1,174 @@
+# author: Le Anh Tai
+# email: leanhtai01@gmail.com
+# GitHub: https://github.com/leanhtai01
+if __package__ is None:
+    import os
+    import sys
+
+    sys.path.append(
+        os.path.dirname(
+            os.path.dirname(
+                os.path.abspath(__file__)
+            )
+        )
+    )
+import argparse
+import os
+import subprocess
+import sys
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import backuputils, fileutils, qcow2utils
+
+
+def check_metadata(backup_dir, vm_name):
+    """check VM's XML and XML of snapshots in snapshots_structure"""
+    problems = []
+
+    def check_xml(path, root_tag):
+        try:
+            root = ElementTree.parse(path).getroot()
+            if root.tag != root_tag:
+                problems.append(f'{path}: root is not <{root_tag}>')
+        except (OSError, ElementTree.ParseError) as error:
+            problems.append(f'{path}: {error}')
+
+    check_xml(f'{backup_dir}/{vm_name}.xml', 'domain')
+
+    try:
+        with open(f'{backup_dir}/snapshots_structure') as reader:
+            snapshot_xmls = reader.read().splitlines()
+    except OSError as error:
+        return problems + [str(error)]
+
+    for snapshot_xml in snapshot_xmls:
+        check_xml(f'{backup_dir}/snapshots/{snapshot_xml}', 'domainsnapshot')
+
+    return problems
+
+
+def check_full_backup(backup_dir, vm_name):
+    """check image copy against its structure and stored digests"""
+    path_to_image = f'{backup_dir}/{vm_name}.qcow2'
+
+    try:
+        result = qcow2utils.check_image(path_to_image)
+    except (OSError, ValueError) as error:
+        return [f'{path_to_image}: {error}']
+
+    problems = [f'{path_to_image}: {error}' for error in result['errors']]
+
+    # backups made before digests were stored only get structure checks
+    saved = fileutils.load_json(f'{path_to_image}.digests.json')
+    if saved:
+        digests = fileutils.hash_file_chunks(
+            path_to_image, saved['chunk_size']
+        )
+        for index, (digest, saved_digest) in enumerate(
+            zip(digests, saved['digests'])
+        ):
+            if digest != saved_digest:
+                problems.append(
+                    f'{path_to_image}: chunk at ' +
+                    f'{index * saved["chunk_size"]} does not match'
+                )
+        if len(digests) != len(saved['digests']):
+            problems.append(f'{path_to_image}: size does not match')
+
+    return problems
+
+
+def find_backups(location):
+    """find (vm name, backup dir, manifest) of every backup in location"""
+    backups = []
+
+    for vm_name in sorted(os.listdir(location)):
+        vm_backup_dir = os.path.join(location, vm_name)
+        if vm_name.startswith('.') or not os.path.isdir(vm_backup_dir):
+            continue
+
+        backup_points = backuputils.get_backup_points(vm_backup_dir)
+        for backup_point in backup_points:
+            point_dir = os.path.join(vm_backup_dir, backup_point)
+            backups.append((
+                vm_name, point_dir,
+                fileutils.load_json(f'{point_dir}/manifest.json')
+            ))
+
+        if not backup_points and \
+                os.path.exists(f'{vm_backup_dir}/{vm_name}.qcow2'):
+            backups.append((vm_name, vm_backup_dir, None))
+
+    return backups
+
+
+def verify_location(location, jobs):
+    """verify all backups in location, return problems of each backup"""
+    backups = find_backups(location)
+
+    # chunks shared by many backups are verified only once
+    store_digests = {}
+    for _, backup_dir, manifest in backups:
+        if manifest:
+            chunks_dir = backuputils.get_chunks_dir(backup_dir, manifest)
+            store_digests.setdefault(chunks_dir, set()).update(
+                backuputils.get_digests(manifest)
+            )
+
+    bad_chunks = {
+        chunks_dir: backuputils.verify_chunks(chunks_dir, digests)
+        for chunks_dir, digests in store_digests.items()
+    }
+
+    def verify(backup):
+        vm_name, backup_dir, manifest = backup
+        problems = check_metadata(backup_dir, vm_name)
+
+        if manifest is None:
+            return problems + check_full_backup(backup_dir, vm_name)
+
+        chunks_dir = backuputils.get_chunks_dir(backup_dir, manifest)
+        return problems + [
+            f'chunk {digest}: {bad_chunks[chunks_dir][digest]}'
+            for digest in backuputils.get_digests(manifest)
+            if digest in bad_chunks[chunks_dir]
+        ]
+
+    with ThreadPoolExecutor(jobs) as executor:
+        return list(zip(
+            [backup_dir for _, backup_dir, _ in backups],
+            executor.map(verify, backups)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='verify backups made by backup_kvm_vm.py'
+    )
+    parser.add_argument('--location', help='backup location')
+    parser.add_argument(
+        '--jobs', type=int, default=4,
+        help='number of backups verified at once (default: 4)'
+    )
+    args = parser.parse_args()
+
+    location = args.location or subprocess.check_output(
+        'read -e -p "Enter backup location: " path; echo $path',
+        shell=True
+    ).decode().strip()
+
+    results = verify_location(location, args.jobs)
+    for backup_dir, problems in results:
+        print(f'{"FAILED" if problems else "OK":<8}{backup_dir}')
+        for problem in problems:
+            print(f'        {problem}')
+
+    if any(problems for _, problems in results):
+        sys.exit(1)
+
+    print('All backups are intact!')
+
+
+if __name__ == '__main__':
+    main()
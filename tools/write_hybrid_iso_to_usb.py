@@ -13,26 +13,63 @@ if __package__ is None:
         )
     )
 import subprocess
-import time
+import sys
 
 from lib import diskutils
 
 
+def print_throughput_table(results):
+    """print per usb throughput table"""
+    print(f'{"USB":<10}{"MiB":>10}{"Seconds":>10}{"MiB/s":>10}  Status')
+
+    for result in results:
+        mebibyte = result['size'] / 1024 ** 2
+        seconds = result['seconds']
+        throughput = mebibyte / seconds if seconds else 0
+        print(
+            f'{result["usb"]:<10}{mebibyte:>10.1f}{seconds:>10.1f}' +
+            f'{throughput:>10.1f}  {result["status"]}'
+        )
+
+
 def main():
     subprocess.run(['lsblk'])
-    usb = input('Enter USB (e.g. sdb, sdc,...): ')
+    usbs = input('Enter USB(s) (e.g. sdb or sdb sdc sdd,...): ').split()
     path_to_iso = subprocess.check_output(
         'read -e -p "Enter path to the iso: " path; echo $path',
         shell=True
     ).decode().strip()
+    is_verify = input('Verify after writing? (y/n): ').lower() == 'y'
+
+    if len(usbs) > 1:
+        results = diskutils.write_hybrid_iso_to_usbs(
+            usbs, path_to_iso, is_verify
+        )
+        print_throughput_table(results)
+
+        if any(result['status'] not in ('done', 'verified')
+               for result in results):
+            sys.exit(1)
+
+        print(f'Successfully write {path_to_iso} to {", ".join(usbs)}!')
+        return
+
+    usb = usbs[0]
+    written = diskutils.write_hybrid_iso_to_usb(usb, path_to_iso)
+    print(f'SHA256 of {path_to_iso}: {written["sha256"]}')
+
+    if is_verify:
+        mismatch_offset = diskutils.verify_device(
+            f'/dev/{usb}', written['size'], written['digests'], path_to_iso
+        )
 
-    diskutils.write_hybrid_iso_to_usb(usb, path_to_iso)
+        if mismatch_offset is not None:
+            print(f'Verify failed! First mismatch at offset {mismatch_offset}')
+            sys.exit(1)
 
-    time.sleep(30)
+        print(f'Verify {written["size"]} bytes on {usb} successfully!')
 
-    subprocess.run([
-        'udisksctl', 'power-off', '-b', f'/dev/{usb}'
-    ])
+    diskutils.power_off_usb(usb)
 
     print(f'Successfully write {path_to_iso} to {usb}!')
 